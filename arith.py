@@ -7,97 +7,307 @@ import sys
 import argparse
 import numpy
 import repipy.utilities as utils
+import repipy.header_index as header_index
 import operator
+import ast
+import math
+import multiprocessing
+import multiprocessing.util
 
 """ Wrapper for imarith using pyraf. The program will perform an operation 
-    between images"""
+    between images. With the operation "=", input2 is an expression with 
+    several images, e.g. 
+    python arith.py *.fits = "(IMG - BIAS) / FLAT" --operand BIAS superbias.fits
+                    --operand FLAT masterflat.fits --suffix " -bf" """
    
     
 def arith(args):
-    output_list = []        
-    for image in args.input1:        
-        # Read inputs as masked arrays or numbers (input2 might be a scalar)  
-        im1 = utils.read_image_with_mask(image, args.mask_key)        
-        try: # if second operand is a number we still need it in a masked array
-            im2 = numpy.ma.array([float(args.input2[0])],mask=[0])
-        except (ValueError,TypeError):
-            im2 = utils.read_image_with_mask(args.input2[0], args.mask_key)        
-
-        # Do the actual operation. Result is a masked array which masks 
-        # any pixel if it is masked either in im1 or in im2.
-        operations = {"+":operator.add, 
-                      "-":operator.sub, 
-                      "*":operator.mul,
-                      "/":operator.div,
-                      "**":operator.pow}
-
+    """ Perform the operation between each of the input1 images and input2, 
+        an image or a number, or the median or mean of input2 (--median, 
+        --mean). The operation is evaluated as the expression "IMG op OPERAND"
+        (see arith_expression). The result is masked where any of the images
+        is masked. """
+    operations = ["+", "-", "*", "/", "**"]
+    if args.operation[0] not in operations:
+        sys.exit("Error! Unknown operation " + args.operation[0] + 
+                 ". Use one of: " + ", ".join(operations) + " or =")
+    operand = "OPERAND"
+    try: # if second operand is a number it is a constant of the expression
+        constants = {"OPERAND":float(args.input2[0])}
+        operands = {}
+    except (ValueError,TypeError):
+        constants = {}
+        operands = {"OPERAND":args.input2[0]}
         # Case of mean or median for Input2 
         if args.median == True:
-            operand2 = numpy.ma.median(im2)
+            operand = "median(OPERAND)"
         elif args.mean == True:
-            operand2 = numpy.ma.mean(im2)
-        else:
-            operand2 = im2.data
-
-        oper = operations[args.operation[0]]
-        result = numpy.zeros_like(im1)
-        result.data[:] = oper(im1.data, operand2)  # Actual operation of images                
-        result.mask[:] = im1.mask | im2.mask       # If any is masked, result is       
-
-
-        # If args.fill_val is present, use it
-        if args.fill_val != '':
-            result.data[:] = result.filled(float(args.fill_val))
-                    
-        # If output exists use it, otherwise use the input. Prefix/suffix might
-        # modify things in next step.
-        if args.output != '': 
-            outpt = os.path.abspath(args.output)
-        else:
-            outpt = os.path.abspath(image)
-            
-        # Separate (path, file) and (file root, extensions). Then build new name. 
-        outdir, outfile = os.path.split(outpt)   
-        outfile_root, outfile_ext = re.match(r'(^.*?)(\..*)', outfile).groups()   
-        outpt = os.path.join(outdir, args.prefix + outfile_root + args.suffix + 
-                             outfile_ext)                         
-
-        # Now name for the mask, if the name exists, use it, otherwise build it.
-        if args.mask_name != "":
-            mask_name = args.mask_name
-        else:
-            mask_name = outpt + ".msk"
-
-        # Prepare a header starting from input1 header 
-        hdr_im = fits.getheader(image)
-        name2 = os.path.split(args.input2[0])[1]
-        if args.median:  # if single number because median used
-            name2 = "median(" + name2 + ") (" + str(im2) + ")"
-        elif args.mean:  # if single number because mean used
-            name2 = "mean(" + name2 + ") (" + str(im2) + ")"
-            
-        # Write a HISTORY element to the header    
-        #hdr_im.add_history(" - Operation performed: " + image + " " + 
-        #                   args.operation[0] + " " + name2)
-        try:
-            hdr_mask = fits.PrimaryHDU(result.mask.astype(int)).header
-        except:
-            print type(im1), type(result), type(im2)
-            print im1
-            print result
-            print im2
-           
-        hdr_mask.add_history("- Mask corresponding to image: " + outpt)
+            operand = "mean(OPERAND)"
+    expression = "IMG " + args.operation[0] + " " + operand
+    return evaluate_images(expression, operands, args, constants=constants)
+
+# Operators and functions that can be used in the expressions (see 
+# parse_expression)
+binary_operators = {ast.Add:operator.add,
+                    ast.Sub:operator.sub,
+                    ast.Mult:operator.mul,
+                    ast.Div:operator.div,
+                    ast.Pow:operator.pow}
+unary_operators = {ast.USub:operator.neg,
+                   ast.UAdd:operator.pos}
+reductions = {"median":numpy.ma.median,
+              "mean":lambda im: numpy.ma.mean(im, dtype=numpy.float64)}
+
+def parse_expression(expression):
+    """ Parse an expression such as "(IMG - BIAS) / FLAT". It can contain 
+        names of images, numbers, the operators +, -, *, /, ** and 
+        parentheses, and the functions median() and mean() of an image. 
+        Returns the tree of the expression and the names of its images. """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval").body
+        return tree, expression_names(tree)
+    except (SyntaxError, ValueError) as error:
+        sys.exit("Error! Invalid expression " + expression + ": " + str(error))
+
+def expression_names(node):
+    """ Names of the images in the tree of an expression. Anything that 
+        evaluate_expression does not know raises a ValueError. """
+    if isinstance(node, ast.BinOp) and type(node.op) in binary_operators:
+        return expression_names(node.left) | expression_names(node.right)
+    elif isinstance(node, ast.UnaryOp) and type(node.op) in unary_operators:
+        return expression_names(node.operand)
+    elif isinstance(node, ast.Num):
+        return set()
+    elif isinstance(node, ast.Name):
+        return set([node.id])
+    elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and \
+         node.func.id in reductions and len(node.args) == 1 and \
+         isinstance(node.args[0], ast.Name) and not node.keywords:
+        return set([node.args[0].id])
+    raise ValueError("not allowed: " + ast.dump(node))
+
+def evaluate_expression(node, pieces, reduced):
+    """ Evaluate the tree of an expression, with the pieces of the images 
+        (name: array) and the values of the functions of the images (see 
+        reduce_images) given. """
+    if isinstance(node, ast.BinOp):
+        return binary_operators[type(node.op)](
+                   evaluate_expression(node.left, pieces, reduced),
+                   evaluate_expression(node.right, pieces, reduced))
+    elif isinstance(node, ast.UnaryOp):
+        return unary_operators[type(node.op)](
+                   evaluate_expression(node.operand, pieces, reduced))
+    elif isinstance(node, ast.Num):
+        return float(node.n)
+    elif isinstance(node, ast.Name):
+        return pieces[node.id]
+    elif isinstance(node, ast.Call):
+        return reduced[(node.func.id, node.args[0].id)]
+
+def reduce_images(tree, readers, names, dtype=numpy.float64):
+    """ Values of the functions (median, mean) of the images in names that 
+        appear in the tree of the expression, as {(function, name): value}. 
+        The whole image is read, with values of type dtype, to calculate them."""
+    reduced = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and node.args[0].id in names:
+            key = (node.func.id, node.args[0].id)
+            if key not in reduced:
+                im = readers[key[1]].read(dtype=dtype)
+                reduced[key] = float(reductions[key[0]](im))
+    return reduced
+
+def rows_per_block(tree, names, ly, max_memory, dtype):
+    """ Number of rows of the images that can be processed at a time with 
+        max_memory bytes. For every pixel of a row, each image of the 
+        expression needs its value and its mask as stored in their files (at
+        most 8 bytes each), the value of type dtype and a boolean mask, each 
+        operator of the expression a temporary value, and the result its 
+        value, its mask and the mask as written (8 bytes). """
+    itemsize = numpy.dtype(dtype).itemsize
+    n_operators = len([node for node in ast.walk(tree) 
+                       if isinstance(node, (ast.BinOp, ast.UnaryOp))])
+    pixel_bytes = len(names) * (8 + 8 + itemsize + 1) + \
+                  n_operators * itemsize + itemsize + 1 + 8
+    return max(1, int(max_memory / (ly * pixel_bytes)))
+
+def arith_expression(args):
+    """ For each of the images of input1, evaluate the expression given as 
+        input2, e.g. "(IMG - BIAS) / FLAT", in which IMG is the image and the
+        rest of the images are given with --operand (e.g. --operand BIAS 
+        superbias.fits). """
+    operands = dict(args.operand)
+    return evaluate_images(args.input2[0], operands, args, history=True)
+
+def evaluate_images(expression, operands, args, history=False, constants=None):
+    """ Evaluate the expression for each of the images of input1 (IMG in the
+        expression, operands are the rest of the images, as name: file) and 
+        write the results. The images are read, the expression is evaluated 
+        and the result is written a block of rows at a time, so that no 
+        intermediate image is ever written, and the memory used (--max_memory)
+        does not depend on the size of the images. A pixel of the result is 
+        masked if it is masked in any of the images of the expression. The 
+        operands (and their median or mean) are only read once. If history is
+        True, the expression is added to the HISTORY of the results. Names in
+        constants (name: number) are numbers, not images (e.g. inf or nan, 
+        which can not be written in the expression). """
+    constants = constants or {}
+    tree, names = parse_expression(expression)
+    names = names - set(constants)
+    unknown = names - set(operands) - set(["IMG"])
+    if unknown:
+        sys.exit("Error! Images in the expression not given with --operand: " +\
+                 ", ".join(sorted(unknown)))
+    operands = dict((name, operands[name]) for name in names if name != "IMG")
+    for image in args.input1:
+        if not utils.check_dimensions([image] + operands.values()):
+            sys.exit("Dimensions of the images in the expression are different!")
+
+    # The functions of the operands are the same for all the images
+    try:
+        reduced = reduce_images(tree, operand_readers(operands, args.mask_key), 
+                                operands, dtype=args.dtype)
+    finally:
+        close_operand_readers()
+    return map_images(expression_image, args, expression=expression, tree=tree,
+                      names=names, operands=operands, reduced=reduced, 
+                      history=history, constants=constants)
+
+def expression_image(image, args, expression, tree, names, operands, reduced,
+                     history=False, constants={}):
+    """ Evaluate the expression (see evaluate_images) for an image of input1
+        and write the result. Returns the name of the result. """
+    outpt, mask_name = output_names(image, args)
+    hdr_im = header_index.get_header(image)
+    if history:  # The full expression goes to the HISTORY
+        line = " - Operation performed: " + expression + " with IMG = " +\
+               os.path.split(image)[1]
+        for name in sorted(operands):
+            line += ", " + name + " = " + os.path.split(operands[name])[1]
+        hdr_im.add_history(line)
+        if args.hdr_message != "":
+            hdr_im.add_history(" - " + args.hdr_message)
+    hdr_mask = fits.Header()
+    hdr_mask.add_history("- Mask corresponding to image: " + outpt)
+    # The result is written to temporary files, renamed when all the images
+    # are read: the output (or its mask) may be one of the inputs
+    tmp_outpt, tmp_mask_name = outpt + ".tmp", mask_name + ".tmp"
+    for name in [tmp_outpt, tmp_mask_name]:
+        if os.path.isfile(name):
+            os.remove(name)
+
+    with utils.MaskedImageReader(image, mask_keyword=args.mask_key) as reader:
+        readers = dict(operand_readers(operands, args.mask_key), IMG=reader)
+        reduced = dict(reduced, **reduce_images(tree, readers, ["IMG"], 
+                                                dtype=args.dtype))
+        lx, ly = reader.header["NAXIS2"], reader.header["NAXIS1"]
+        step = rows_per_block(tree, names, ly, 
+                              utils.memory_size_to_bytes(args.max_memory), 
+                              args.dtype)
+        with utils.MaskedImageWriter(tmp_outpt, (lx, ly), args.dtype, 
+                                     header=hdr_im, mask_name=tmp_mask_name, 
+                                     mask_header=hdr_mask,
+                                     mask_dtype=numpy.int0, mef=args.mef, 
+                                     compress=args.compress) as writer:
+            for xmin in range(0, lx, step):
+                xmax = min(xmin + step, lx)
+                pieces = dict((name, readers[name].read([xmin, 0, xmax, ly],
+                                                        dtype=args.dtype))
+                              for name in names)
+                data = numpy.zeros([xmax - xmin, ly], dtype=args.dtype)
+                mask = numpy.zeros([xmax - xmin, ly], dtype=bool)
+                data[:] = evaluate_expression(tree, dict(constants, 
+                    **dict((name, pieces[name].data) for name in names)), reduced)
+                for name in names:
+                    mask |= numpy.ma.getmaskarray(pieces[name])
+
+                # If args.fill_val is present, use it
+                if args.fill_val != '':
+                    data[mask] = float(args.fill_val)
+                writer.write(data, mask)
+    os.rename(tmp_outpt, outpt)
+    if not args.mef:
+        os.rename(tmp_mask_name, mask_name)
+    return outpt
+
+################################################################################
+# Readers of the operands of the expression open in this process (the main 
+# one or one of the pool, see --jobs), by name. 
+_operand_readers = {}
+
+def operand_readers(operands, mask_key):
+    """ Readers (utils.MaskedImageReader) of the operands of an expression 
+        (name: file), opened only the first time they are needed. """
+    for name in operands:
+        if name not in _operand_readers:
+            _operand_readers[name] = utils.MaskedImageReader(operands[name], 
+                                                       mask_keyword=mask_key)
+    return _operand_readers
+
+def close_operand_readers():
+    """ Close the readers opened by operand_readers """
+    for name in _operand_readers.keys():
+        _operand_readers.pop(name).close()
+
+# Function (and its arguments besides the image) applied to each image of 
+# input1 by map_images. It is set before the pool of processes is created, 
+# so the processes, forked from the main one, share it without copying or 
+# pickling it.
+_image_function = None
+_image_function_kwargs = {}
+
+def _init_pool_process():
+    """ The readers opened in every process of the pool are closed when the 
+        process finishes, after pool.close() and pool.join(). """
+    multiprocessing.util.Finalize(None, close_operand_readers, exitpriority=10)
+
+def _apply_image_function(task):
+    """ Pool.imap passes a single argument, unpack it for _image_function """
+    image, args = task
+    return _image_function(image, args, **_image_function_kwargs)
+
+def map_images(function, args, **kwargs):
+    """ Apply function(image, args, **kwargs) to each of the input1 images, 
+        with a pool of args.jobs processes if more than one. Returns the list
+        of results, in the same order as the images. """
+    global _image_function, _image_function_kwargs
+    _image_function, _image_function_kwargs = function, kwargs
+    tasks = [(image, args) for image in args.input1]
+    try:
+        if args.jobs > 1:
+            pool = multiprocessing.Pool(processes=args.jobs, 
+                                        initializer=_init_pool_process)
+            try:
+                return pool.map(_apply_image_function, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        return [_apply_image_function(task) for task in tasks]
+    finally:
+        close_operand_readers()
+        _image_function, _image_function_kwargs = None, {}
+
+def output_names(image, args):
+    """ Names of the image and mask that result from the image of input1 """
+    # If output exists use it, otherwise use the input. Prefix/suffix might
+    # modify things in next step.
+    if args.output != '': 
+        outpt = os.path.abspath(args.output)
+    else:
+        outpt = os.path.abspath(image)
         
-        # Now save the resulting image and mask
-        if os.path.isfile(outpt):
-            os.remove(outpt)
-        if os.path.isfile(mask_name):
-            os.remove(mask_name)
-        fits.writeto(outpt, result.data, header=hdr_im) 
-        fits.writeto(mask_name, result.mask.astype(numpy.int0), header=hdr_mask)
-        output_list.append(outpt)
-    return output_list
+    # Separate (path, file) and (file root, extensions). Then build new name. 
+    outdir, outfile = os.path.split(outpt)   
+    outfile_root, outfile_ext = re.match(r'(^.*?)(\..*)', outfile).groups()   
+    outpt = os.path.join(outdir, args.prefix + outfile_root + args.suffix + 
+                         outfile_ext)                         
+
+    # Now name for the mask, if the name exists, use it, otherwise build it.
+    if args.mask_name != "":
+        mask_name = args.mask_name
+    else:
+        mask_name = outpt + ".msk"
+    return outpt, mask_name
 
 ########################################################################################################################
 
@@ -110,9 +320,17 @@ parser.add_argument("input1", metavar='input1', action='store', help='list of '
                     'input images from which to subtract another image or value', \
                     nargs="+", type=str)
 parser.add_argument("operation", metavar='operation', action='store', type=str, 
-		   help='type of operation (+,-,*,/) to be done', nargs=1)
+		   help='type of operation (+,-,*,/) to be done, or = to evaluate '+\
+                   'the expression given in input2', nargs=1)
 parser.add_argument("input2",metavar='input2', action='store', nargs=1,  \
-                    help='image (or value) with which to perform the operation')
+                    help='image (or value) with which to perform the operation, '+\
+                    'or expression (e.g. "(IMG - BIAS) / FLAT") if the operation '+\
+                    'is =. IMG is each of the input1 images, the rest of the '+\
+                    'images are named with --operand. Numbers, +, -, *, /, **, '+\
+                    'parentheses and median() or mean() of an image can be used.')
+parser.add_argument("--operand", metavar=("name", "image"), dest='operand', \
+                    action='append', nargs=2, default=[], help='Name and file '+\
+                    'of an image of the expression. Use it once per image.')
 parser.add_argument("--output", metavar='output', dest='output', action='store', \
                    default='', help='output image in which to save the result.' +\
                    'If not stated, then the --prefix or --suffix must be present.')
@@ -140,11 +358,34 @@ parser.add_argument("--mask_name", metavar="mask_name", dest='mask_name', \
                     action='store', default="", help=' Name for the resulting ' +\
                     'mask. If the pixel of any of the images is masked out, the '+\
                     'resulting mask will obviously be masked out as well.')         
+parser.add_argument("--mef", action="store_true", dest="mef", default=False, \
+                    help=' Write the mask as an 8 bits extension (MASK) of the '+\
+                    'resulting image instead of a separate file (--mask_name '+\
+                    'is then ignored). Default: No')
+parser.add_argument("--compress", action="store_true", dest="compress", \
+                    default=False, help=' Tile compress the MASK extension '+\
+                    'written with --mef. Default: No')
 parser.add_argument("--fill_val", metavar="fill_val", dest="fill_val", 
                     action="store", default='', help=' If present, ' +\
                     'this value will be used to fill masked pixels in the ' +\
                     'final image. By default no filling is used, and the '+\
                     'original value is used')
+parser.add_argument("--dtype", metavar="dtype", dest="dtype", action='store', \
+                    default="float64", choices=["float64", "float32"], \
+                    help=' Type of the values used in the operation and of the '+\
+                    'resulting image. float32 is enough for 16 bits raw images '+\
+                    'and halves the memory (and disk) needed. Default: float64')
+parser.add_argument("--jobs", metavar="jobs", dest="jobs", type=int, \
+                    action='store', default=1, help=' Number of processes '+\
+                    'used to operate on the input1 images in parallel. input2 '+\
+                    '(or the --operand images) is read only once and shared '+\
+                    'with all of them. Default: 1.')
+parser.add_argument("--max_memory", metavar="max_memory", dest="max_memory", \
+                    action='store', default="256MB", help=' Maximum memory '+\
+                    '(e.g. "2GB", "512MB") used by each process to operate '+\
+                    'on an image. The images are read, operated and written '+\
+                    'a block of rows at a time, with as many rows as fit in '+\
+                    'it. Default: 256MB')
 parser.add_argument("--overwrite", action="store_true", dest="overwrite", \
                     default=False, help="Allows you to overwrite the original image.")
 parser.add_argument("--mean", action="store_true", dest="mean", default=False, \
@@ -172,7 +413,10 @@ def main(arguments = None):
   if args.output == '' and args.prefix == '' and args.suffix == '' and args.overwrite == False:  
       sys.exit("Error! Introduce a prefif, a suffix, the --overwrite option or the --output option. \
 			  For help: python arith.py -h ") 
-  newname = arith(args) 
+  if args.operation[0] == "=":
+      newname = arith_expression(args)
+  else:
+      newname = arith(args) 
   
   if len(newname) == 1:   # If just one element, send back an element, not a list
       newname = newname[0]
@@ -7,6 +7,7 @@ Created on Tue Jul  9 11:03:50 2013
 """
 
 import repipy.utilities as utilities
+import repipy.catalogues as catalogues
 import subprocess
 import os
 
@@ -51,7 +52,5 @@ def main(im_name, ra=None, dec=None, FoV=None):
     corr_file = utilities.replace_extension(im_name, "corr")
     table = fits.open(corr_file)[1]
     cat_radec = utilities.replace_extension(im_name, "radec")
-    f = open(cat_radec, "w")
-    for line in table.data:
-        f.write(str(line[2]) + " " + str(line[3]) + "\n")
-    f.close()
+    catalogues.write_columns(cat_radec, [table.data.field(2),
+                                          table.data.field(3)])
@@ -1,78 +1,230 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+""" Calculate the local sidereal time, hour angle and airmass of a list of
+    images from the date, UT and coordinates in their headers, and include
+    them in the headers. All the images are done at once, with numpy arrays,
+    and each header is updated only once. The airmass is the effective one of
+    IRAF's setairmass: (X_start + 4 * X_middle + X_end) / 6 over the exposure.
+
+    E.g.: python calculate_airmass.py --observatory OSN --date DATE-OBS
+                 --ut UT --RA RA_hours --DEC DEC_deg --equinox EQUINOX *.fits
+"""
+
 import astropy.io.fits as fits
 import sys
+import numpy
 import repipy.utilities as utils
-from pyraf import iraf
+import repipy.header_index as header_index
 import argparse
+
+# Longitude (degrees, positive towards the west, as in complete_headers.py)
+# and latitude (degrees) of the observatories
+observatories = {"OSN":(3.38472, 37.06417),
+                 "CAHA":(2.54625, 37.22361),
+                 "ORM":(17.87917, 28.75833),
+                 "KPNO":(111.6, 31.96333),
+                 "CTIO":(70.815, -30.16528)}
+
 parser = argparse.ArgumentParser(description='Check header for airmass and '+\
                                 'include it if missing and possible. From the '+\
                                 'local time, sidereal time and universal time '+\
                                 'we need at least UT. ')
 parser.add_argument("input", metavar='input', action='store', nargs="+", \
-                    help='Image(s) for which airmass will be checked.') 
+                    help='Image(s) for which airmass will be checked.')
 parser.add_argument("--ut", metavar='UT', action='store', dest='UT', default='',\
-                    help=" Keyword for Universal Time (hh:mm:ss).")
+                    help=" Keyword for Universal Time (hh:mm:ss) at the start "+\
+                    "of the exposure. If not given, the date keyword must "+\
+                    "contain the time too (yyyy-mm-ddThh:mm:ss).")
 parser.add_argument("--st", metavar='ST', action='store', dest='ST', default='ST', \
                     help=" OUTPUT Keyword for Local Sidereal Time (hh:mm:ss)")
+parser.add_argument("--ha", metavar='HA', action='store', dest='HA', default='HA', \
+                    help=" OUTPUT Keyword for the Hour Angle (hours)")
 parser.add_argument("--lt", metavar='LT', action='store', dest='LT', default='LT',\
-                    help=" OUTPUT Keyword for Local Time (hh:mm:ss) ")
+                    help=" OUTPUT Keyword for Local Time (hh:mm:ss). Only "+\
+                    "written if --location is given.")
+parser.add_argument("--airmass", metavar='airmass', action='store', \
+                    dest='airmass', default='AIRMASS', help=" OUTPUT Keyword "+\
+                    "for the (effective) airmass. Default: AIRMASS")
 parser.add_argument("--RA", metavar='Right ascension', action='store', dest='ra',\
                     default='', help= "Keyword for Right ascension of the object "+\
-                    "in hours!!! (3.45 or 23.2 or 12.56)")
+                    "in hours!!! (3.45 or 23.2 or 12.56, or hh:mm:ss)")
 parser.add_argument("--DEC", metavar='Declination', action='store', dest='dec',\
                     default='', help= "Keyword for the Declination of the object "+\
-                    "in degrees (80.437, 23.61, 12.6)")
+                    "in degrees (80.437, 23.61, 12.6, or dd:mm:ss)")
 parser.add_argument("--date", metavar='date', action='store', dest='date',\
                     default='', help=" Keyword for date (yyyy-mm-dd) ")
+parser.add_argument("--exptime", metavar='exptime', action='store', \
+                    dest='exptime', default='EXPTIME', help=" Keyword for the "+\
+                    "exposure time (seconds). Images without it get the airmass "+\
+                    "at the start of the exposure. Default: EXPTIME")
 parser.add_argument("--observatory", metavar='Observatory', action='store', \
                     dest='observatory', default='', help=" Name of Observatory "+\
-                    "of origin. E.g. OSN, ORM, ... ")
+                    "of origin. One of: " + ", ".join(sorted(observatories)) +\
+                    ". Others can be given with --longitude and --latitude.")
+parser.add_argument("--longitude", metavar="longitude", action='store', \
+                    dest="longitude", type=float, default=None, help=" Longitude "+\
+                    "of the observatory (degrees, positive towards the west). "+\
+                    "Overrides the one of --observatory.")
+parser.add_argument("--latitude", metavar="latitude", action='store', \
+                    dest="latitude", type=float, default=None, help=" Latitude "+\
+                    "of the observatory (degrees). Overrides the one of "+\
+                    "--observatory.")
 parser.add_argument("--location", metavar='location', action='store', dest='location',\
                     default='', help=" Time zone location. E.g.: 'Europe/Madrid' ")
 parser.add_argument("--equinox", metavar='equinox', action='store', dest='equinox',\
-                    default='', help=" Keyword for equinox of the coordinates ")
+                    default='', help=" Keyword for equinox of the coordinates. "+\
+                    "If not given, J2000 is assumed.")
+
+################################################################################
+def sexagesimal_to_float(value):
+    """ Value of a header keyword, either a number or a string "dd:mm:ss.s"
+        (or "dd mm ss.s"), as a float in the same units as its first field """
+    if not isinstance(value, str):
+        return float(value)
+    fields = value.replace(":", " ").split()
+    sign = -1. if fields[0].startswith("-") else 1.
+    return sign * sum(abs(float(field)) / 60**ii for ii, field in enumerate(fields))
+
+def hours_to_sexagesimal(values):
+    """ Times of the day, in hours, as strings "hh:mm:ss.s" """
+    tenths = numpy.round(numpy.mod(values, 24.) * 36000).astype(int) % 864000
+    return ["%02d:%02d:%04.1f" % (t / 36000, t / 600 % 60, t % 600 / 10.)
+            for t in tenths]
+
+def days_since_j2000(dates, times):
+    """ Days since J2000.0 (2000-01-01 12:00 UT) of the dates (yyyy-mm-dd)
+        and UT times (hh:mm:ss). If times is None the dates include the time
+        (yyyy-mm-ddThh:mm:ss). """
+    if times is None:
+        stamps = [date.replace(" ", "T") for date in dates]
+    else:
+        stamps = [date[:10] + "T" + time for date, time in zip(dates, times)]
+    stamps = numpy.array(stamps, dtype="datetime64[ms]")
+    return (stamps - numpy.datetime64("2000-01-01T12:00:00")) / \
+            numpy.timedelta64(1, "D")
+
+def sidereal_time(days, longitude):
+    """ Local sidereal time (hours) at the days since J2000.0 for a longitude
+        in degrees, positive towards the west. Greenwich mean sidereal time
+        from the expression of the USNO, good to ~0.1 s over a century. """
+    centuries = days / 36525.
+    gmst = 18.697374558 + 24.06570982441908 * days + 0.000026 * centuries**2
+    return numpy.mod(gmst - longitude / 15., 24.)
 
+def precess(ra, dec, equinox, days):
+    """ Precess RA (hours) and DEC (degrees) from equinox (julian years) to
+        the dates, given as days since J2000.0 (IAU 1976 precession). """
+    def rotation(t):
+        """ Precession matrices from J2000 to t julian centuries after it """
+        arcsec = numpy.pi / (180. * 3600.)
+        zeta = (2306.2181 * t + 0.30188 * t**2 + 0.017998 * t**3) * arcsec
+        z = (2306.2181 * t + 1.09468 * t**2 + 0.018203 * t**3) * arcsec
+        theta = (2004.3109 * t - 0.42665 * t**2 - 0.041833 * t**3) * arcsec
+        cz, sz, ct, st = numpy.cos(zeta), numpy.sin(zeta), numpy.cos(theta), numpy.sin(theta)
+        cZ, sZ = numpy.cos(z), numpy.sin(z)
+        return numpy.array([[cZ*ct*cz - sZ*sz, -cZ*ct*sz - sZ*cz, -cZ*st],
+                            [sZ*ct*cz + cZ*sz, -sZ*ct*sz + cZ*cz, -sZ*st],
+                            [st*cz, -st*sz, ct]])
+    alpha, delta = numpy.radians(ra * 15.), numpy.radians(dec)
+    vector = numpy.array([numpy.cos(delta) * numpy.cos(alpha),
+                          numpy.cos(delta) * numpy.sin(alpha), numpy.sin(delta)])
+    to_j2000 = rotation((equinox - 2000.) / 100.)
+    vector = numpy.einsum("jin,jn->in", to_j2000, vector)  # inverse = transpose
+    vector = numpy.einsum("ijn,jn->in", rotation(days / 36525.), vector)
+    ra_date = numpy.mod(numpy.degrees(numpy.arctan2(vector[1], vector[0])) / 15., 24.)
+    dec_date = numpy.degrees(numpy.arcsin(numpy.clip(vector[2], -1., 1.)))
+    return ra_date, dec_date
+
+def hour_angle(lst, ra):
+    """ Hour angle (hours, between -12 and 12) from sidereal time and RA """
+    return numpy.mod(lst - ra + 12., 24.) - 12.
+
+def airmass(ha, dec, latitude):
+    """ Airmass for hour angles (hours), declinations and latitude (degrees),
+        from the spherical atmosphere of IRAF's astutil (scale height 750) """
+    ha, dec, latitude = numpy.radians(ha * 15.), numpy.radians(dec), numpy.radians(latitude)
+    cos_zd = numpy.sin(latitude) * numpy.sin(dec) + \
+             numpy.cos(latitude) * numpy.cos(dec) * numpy.cos(ha)
+    scale = 750.
+    x = scale * cos_zd
+    return numpy.sqrt(x**2 + 2 * scale + 1) - x
+
+def effective_airmass(days, exptimes, ra, dec, longitude, latitude):
+    """ Effective airmass of exposures starting at days (since J2000.0) and
+        lasting exptimes (seconds): Simpson's rule over start, middle, end """
+    airmasses = [airmass(hour_angle(sidereal_time(days + fraction * exptimes / 86400.,
+                                                  longitude), ra), dec, latitude)
+                 for fraction in [0, 0.5, 1]]
+    return (airmasses[0] + 4 * airmasses[1] + airmasses[2]) / 6.
+
+################################################################################
 def estimate_airmass(args):
+    """ Calculate sidereal time, hour angle and airmass of all the images and
+        write them to their headers """
+    longitude, latitude = observatories.get(args.observatory.upper(), (None, None))
+    if args.longitude is not None:
+        longitude = args.longitude
+    if args.latitude is not None:
+        latitude = args.latitude
+    if longitude is None or latitude is None:
+        sys.exit("Unknown observatory " + args.observatory + ", give its "+\
+                 "--longitude and --latitude")
+
+    # Read all the variables from the headers
+    keywords = [args.date, args.ra, args.dec] + [key for key in [args.UT] if key]
+    values = [header_index.get_values(image, *keywords) for image in args.input]
+    dates = [str(value[0]) for value in values]
+    times = [str(value[3]) for value in values] if args.UT else None
+    ra = numpy.array([sexagesimal_to_float(value[1]) for value in values])
+    dec = numpy.array([sexagesimal_to_float(value[2]) for value in values])
+    equinox, exptimes = [], []
     for image in args.input:
+        value = 2000.
+        if args.equinox != "":
+            try:
+                value = float(str(utils.get_from_header(image,
+                                                        args.equinox)).lstrip("JB"))
+            except (KeyError, ValueError):  # missing, or blank value
+                pass
+        equinox.append(value)
+        try:
+            exptimes.append(float(utils.get_from_header(image, args.exptime)))
+        except (KeyError, ValueError):
+            exptimes.append(0.)
+
+    # And calculate, for all of them at once
+    days = days_since_j2000(dates, times)
+    ra, dec = precess(ra, dec, numpy.array(equinox), days)
+    lst = sidereal_time(days, longitude)
+    ha = hour_angle(lst, ra)
+    airmasses = effective_airmass(days, numpy.array(exptimes), ra, dec,
+                                  longitude, latitude)
+
+    # One update of every header
+    for index, image in enumerate(args.input):
         im = fits.open(image, mode="update")
         hdr = im[0].header
-        
-        # Read all the variables from the header
-        date = hdr[args.date]        
-        UT = hdr[args.UT]        
-        location = args.location 
-        if hdr.has_key("AIRMASS"):
-            hdr.update("AIRM_0", hdr["AIRMASS"], "Original airmass (not recalcul)")
-        
-        # Calculate local time from UT. If user provides with a name for LT in 
-        # the header save it. Otherwise no need to save it. 
-        LT = utils.universal_time_to_local_time(date, UT, location)
-        if args.LT != "":
-            hdr.update(args.LT, LT, " Local time ")
-            print "Local time ", LT
-            
-        # Calculate local sidereal time from local time and location of observ.
-        ST = utils.local_to_sidereal_time(date, LT, args.observatory)
-        hdr.update(args.ST, ST, " Local sidereal time ")    
-    
+        if args.airmass in hdr and "AIRM_0" not in hdr:
+            hdr["AIRM_0"] = (hdr[args.airmass], "Original airmass (not recalcul)")
+        if args.location != "" and args.LT != "":
+            date = dates[index][:10]
+            UT = times[index] if times else dates[index][11:19]
+            hdr[args.LT] = (utils.universal_time_to_local_time(date, UT[:8],
+                                                               args.location),
+                            " Local time ")
+        hdr[args.ST] = (hours_to_sexagesimal([lst[index]])[0], " Local sidereal time ")
+        hdr[args.HA] = (round(ha[index], 6), " Hour angle (hours) ")
+        hdr[args.airmass] = (round(airmasses[index], 4), " Effective airmass ")
         im.flush()
         im.close()
-        
-        # Finally, estimate airmass, including it in the header
-        iraf.module.load("astutil", doprint=0)
-        iraf.module.setairmass(images=image, observa=args.observatory, ra=args.ra,\
-                                dec=args.dec, st=args.ST, ut=args.UT,\
-                                equinox=args.equinox)        
-        
-    return None       
-       
+    return airmasses
+
 
 def main(arguments=None):
     if arguments == None:
         arguments = sys.argv[1:]
-    args = parser.parse_args(arguments)   
+    args = parser.parse_args(arguments)
     estimate_airmass(args)
 
 if __name__ == "__main__":
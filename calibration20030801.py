@@ -155,11 +155,12 @@ for ii, im_name in enumerate(list_images["filename"]):
         arith_images.main(arguments=["--output", newname, "--message", mssg, "--mask_key", "MASK", im_name, "/", str(tt)])
         mssg = "Before normalizing: " + str(tt)
         # Update values for the exptime, the sky, the sky std...
-        utils.header_update_keyword(newname, exptimek, 1, mssg)
         ss = float(utils.get_from_header(im_name, skyk))
-        utils.header_update_keyword(newname, skyk, ss/tt)
         ss_std = float(utils.get_from_header(im_name, sky_stdk))
-        utils.header_update_keyword(newname, skyk, ss_std/tt)
+        with utils.HeaderTransaction(newname) as hdr:
+            hdr.update(exptimek, 1, mssg)
+            hdr.update(skyk, ss/tt)
+            hdr.update(skyk, ss_std/tt)
         list_images["filename"][ii] = newname
 
 
@@ -175,9 +176,10 @@ for ii, im_name in enumerate(list_images["filename"]):
                                      "--mask_key", "MASK",
                                      im_name, "*", str(correcting_factor)])
         mssg = "Before correcting for atmosphere: " + str(airmass)
-        utils.header_update_keyword(newname, airmassk, 0, comment=mssg)
-        utils.header_update_keyword(newname, "k_coeff", ext_coeff, comment="Extinction coefficient")
-        utils.header_update_keyword(newname, "k_err", sigma_ext_coeff, comment="Extinction coefficient 1-sigma")
+        with utils.HeaderTransaction(newname) as hdr:
+            hdr.update(airmassk, 0, comment=mssg)
+            hdr.update("k_coeff", ext_coeff, comment="Extinction coefficient")
+            hdr.update("k_err", sigma_ext_coeff, comment="Extinction coefficient 1-sigma")
         list_images["filename"][ii] = newname
 
 print "Calculate zero point from the standards"
@@ -204,8 +206,9 @@ zp, sigma_zp = 37.7, 0.03
 for im_name in list_images["filename"]:
     filter = utils.get_from_header(im_name, filterk)
     if filter == "H6678":
-        utils.header_update_keyword(im_name, "ZP", zp, "AB magnitude zero point." )
-        utils.header_update_keyword(im_name, "ZP_err", sigma_zp, "Zero point 1-sigma. ")
+        with utils.HeaderTransaction(im_name) as hdr:
+            hdr.update("ZP", zp, "AB magnitude zero point." )
+            hdr.update("ZP_err", sigma_zp, "Zero point 1-sigma. ")
 
 
 print "Combine images of same object and filter"
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Read and write the text catalogues of the pipeline: SExtractor catalogues,
+    IRAF text databases (daofind, phot... what txdump reads) and plain columns
+    of numbers (e.g. the .radec files of the stars of an image). Catalogues are
+    read into numpy structured arrays, one field per column, and kept in a
+    binary sidecar (catalogue + ".npz") with the modification and change times,
+    size and inode of the catalogue, so the text is only parsed again if the
+    catalogue changes.
+
+    E.g.: stars = catalogues.read_sextractor("image.cat")
+          x, y = stars["X_IMAGE"], stars["Y_IMAGE"]
+          catalogues.write_columns("image.radec", [ra, dec])
+"""
+
+import os
+import StringIO
+import numpy as np
+
+def sidecar_name(filename):
+    """ Name of the binary copy of a catalogue """
+    return filename + ".npz"
+
+def _stamp(filename):
+    """ Modification and change times, size and inode of the catalogue, what
+        tells whether it changed (e.g. rewritten within the resolution of the
+        times of the filesystem) """
+    stat = os.stat(filename)
+    return np.array([stat.st_mtime, stat.st_ctime]), \
+           np.array([stat.st_size, stat.st_ino], dtype=np.int64)
+
+def _save_sidecar(filename, catalogue, stamp):
+    """ Save the structured array of the catalogue next to it, with the stamp
+        of the catalogue it was read from, which is how the copy is known to be
+        current. The catalogue is still usable if the copy can not be 
+        written. """
+    sidecar = sidecar_name(filename)
+    try:
+        with open(sidecar + ".tmp", "wb") as f:
+            np.savez(f, catalogue=catalogue, times=stamp[0], sizes=stamp[1])
+        os.rename(sidecar + ".tmp", sidecar)
+    except (IOError, OSError):
+        pass
+
+def _cached(filename, parse):
+    """ Catalogue from its binary copy if that is current, otherwise parsed
+        from the text (by parse) and saved as the binary copy """
+    sidecar = sidecar_name(filename)
+    stamp = _stamp(filename)  # before parsing, in case it changes meanwhile
+    if os.path.isfile(sidecar):
+        try:
+            with np.load(sidecar) as copy:
+                if np.array_equal(copy["times"], stamp[0]) and \
+                   np.array_equal(copy["sizes"], stamp[1]):
+                    return copy["catalogue"]
+        except (IOError, ValueError, KeyError):  # not a (complete) copy
+            pass
+    catalogue = parse(filename)
+    _save_sidecar(filename, catalogue, stamp)
+    return catalogue
+
+def _from_columns(data, names, widths=None):
+    """ Structured array from a 2D array of numbers, with a field per name.
+        A field of width > 1 (e.g. FLUX_APER of SExtractor, for several
+        apertures) takes that many consecutive columns. """
+    if widths is None:
+        widths = [1] * len(names)
+    dtype = [(name, data.dtype) if width == 1 else (name, data.dtype, (width,))
+             for name, width in zip(names, widths)]
+    catalogue = np.empty(len(data), dtype=dtype)
+    column = 0
+    for name, width in zip(names, widths):
+        if width == 1:
+            catalogue[name] = data[:, column]
+        else:
+            catalogue[name] = data[:, column:column + width]
+        column += width
+    return catalogue
+
+def _parse_sextractor(filename):
+    """ Parse a SExtractor catalogue (ASCII_HEAD), whose header has a line
+        "#   N NAME  description" for the column N (from 1) of each parameter """
+    names, first_columns = [], []
+    with open(filename) as f:
+        for line in f:
+            if not line.startswith("#"):
+                break
+            fields = line.split()
+            names.append(fields[2])
+            first_columns.append(int(fields[1]) - 1)
+    data = np.loadtxt(filename, comments="#", ndmin=2)
+    widths = np.diff(first_columns + [data.shape[1]])
+    return _from_columns(data, names, widths)
+
+def read_sextractor(filename):
+    """ SExtractor catalogue as a structured array, with a field per
+        parameter (NUMBER, X_IMAGE, MAG_AUTO...) """
+    return _cached(filename, _parse_sextractor)
+
+def _parse_iraf(filename):
+    """ Parse an IRAF text database (the output of daofind, phot...). The
+        names of the fields are in the "#N" lines, and both these and the
+        records can continue in the next line if they end with a backslash.
+        INDEF values are read as nan. """
+    names, records, record = [], [], ""
+    with open(filename) as f:
+        for line in f:
+            if line.startswith("#"):
+                if line.startswith("#N"):
+                    names.extend(line[2:].replace("\\", " ").split())
+                continue
+            line = line.rstrip()
+            if line.endswith("\\"):
+                record += line[:-1] + " "
+            elif line or record:
+                records.append(record + line)
+                record = ""
+    catalogue = np.genfromtxt(StringIO.StringIO("\n".join(records)), 
+                              dtype=None, names=names, missing_values="INDEF",
+                              filling_values=np.nan)
+    return np.atleast_1d(catalogue)  # also with only one record
+
+def read_iraf(filename):
+    """ IRAF text database as a structured array, with a field per column
+        (XCENTER, YCENTER, MAG...), as txdump would give them """
+    return _cached(filename, _parse_iraf)
+
+def _parse_columns(filename):
+    """ Parse a file of columns of numbers separated by blanks """
+    data = np.loadtxt(filename, ndmin=2)
+    return _from_columns(data, ["col" + str(ii) for ii in range(data.shape[1])])
+
+def read_columns(filename):
+    """ Columns of numbers of a file (e.g. a .radec file) as a structured
+        array, with fields col0, col1... """
+    return _cached(filename, _parse_columns)
+
+def write_columns(filename, columns, fmt=None, delimiter=" "):
+    """ Write columns of numbers (e.g. RA and DEC of stars) to a file, a row
+        per line, and its binary copy. By default each value is written as
+        str() gives it, in its own type (a float32 is not widened to float64
+        first); otherwise with the format fmt (e.g. "%.6f"). The binary copy
+        holds the values as written, as reading the file would give them. """
+    if fmt is None:
+        text = lambda value: str(value)
+    else:
+        text = lambda value: fmt % value
+    rows = [[text(value) for value in row] for row in
+            zip(*[np.atleast_1d(column) for column in columns])]
+    with open(filename, "w") as f:
+        for row in rows:
+            f.write(delimiter.join(row) + "\n")
+    data = np.array([[float(value) for value in row] for row in rows],
+                    dtype=np.float64).reshape(len(rows), len(columns))
+    _save_sidecar(filename, _from_columns(data, ["col" + str(ii) for ii in
+                                                 range(data.shape[1])]),
+                  _stamp(filename))
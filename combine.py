@@ -4,42 +4,142 @@
 ###############################################################################
 import os
 import argparse
+import math
+import multiprocessing
+import multiprocessing.util
 import numpy
 from scipy.stats import mode as mode
 import sys
 import astropy.io.fits as fits
 import collections
 import repipy.utilities as utils
-import repipy.arith as arith_images
+import repipy.header_index as header_index
 import repipy.find_keywords as find_keywords
 
-def home_made_median(map_cube, cube):
-    """ map_cube indicates the number of elements of cube that are not 
-        masked. For the sort that we did before, masked elements are sorted 
-        as if they had the very highest values. So, if map[ii,jj] = 5
-        we know that the first 5 elements of cube[:,ii,jj] are not masked
-        and that the rest are masked. So, the median will be cube[2,ii,jj]
-        for the pixel [ii,jj] of the images. Of course, there will be points
-        of map that will be even, so the median will be the mean of elements
-        N//2 and (N-1)//2, where N is the value of map for the given pixel.
-        That is what we call indicesz_above and below. We will average
-        the two resulting images. """
-
-    lx, ly = map_cube.shape 
-    indicesz_above = (map_cube // 2).flatten() 
-    indicesz_below = ((map_cube-1) // 2).flatten()
-    indicesx, indicesy = numpy.where(map_cube == map_cube)
-    image_above = cube[indicesz_above, indicesx, indicesy].reshape((lx,ly))
-    image_below = cube[indicesz_below, indicesx, indicesy].reshape((lx,ly))
-    image = (image_above + image_below) / 2.
-    return image
+def nan_median(cube, map_cube):
+    """ Median along the first axis of cube, in which the masked elements have
+        been replaced by NaN. map_cube indicates the number of elements of 
+        cube that are not masked for each pixel. numpy.partition moves the NaN
+        to the end, exactly as a sort would do, so for a pixel with map = 5 
+        we only need to partition its values around the third element (index 
+        2), with no need to sort them. When map is even the median will be 
+        the mean of elements N//2 and (N-1)//2, where N is the value of map 
+        for the pixel. Pixels with the same N are partitioned together, and 
+        those without any valid value are masked in the result. """
+    lz = cube.shape[0]
+    values = cube.reshape(lz, -1)
+    counts = map_cube.flatten()
+    image = numpy.zeros(counts.shape, dtype=cube.dtype)
+    for n in numpy.unique(counts[counts > 0]):
+        pixels = numpy.where(counts == n)[0]
+        index_above, index_below = n // 2, (n - 1) // 2
+        selection = values[:, pixels]
+        selection.partition(sorted(set([index_below, index_above])), axis=0)
+        image[pixels] = (selection[index_above] + selection[index_below]) / 2.
+    image = image.reshape(map_cube.shape)
+    return numpy.ma.array(image, mask=(map_cube == 0))
+
+def clip_cube(cube, lsigma, hsigma, maxiters, ccd_noise=None):
+    """ Iteratively reject (i.e. mask, in place) the elements of the masked 
+        cube that are more than lsigma sigmas below or hsigma sigmas above the
+        median of their pixel. sigma is the standard deviation around the 
+        median of the values of the pixel that have survived so far. In the 
+        first iteration, when the outliers are still there to inflate it, it 
+        is estimated from the median absolute deviation (MAD) instead. If 
+        ccd_noise is given, sigma is the noise expected from the CCD: 
+        ccd_noise(median) must return the sigma of every element of the cube.
+        Every iteration checks all the values that were valid originally, so 
+        values rejected by a noisy first estimate can be recovered later. 
+        Pixels with less than three valid values are not clipped. Iterations 
+        stop when the rejected values do not change or after maxiters. """
+    original_mask = cube.mask.copy()
+    original_values = cube.filled(numpy.nan)
+    original_map = numpy.ma.count(cube, axis=0)
+    for iteration in range(maxiters):
+        map_cube = numpy.ma.count(cube, axis=0)
+        values = cube.filled(numpy.nan)
+        center = nan_median(values, map_cube).data
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            residuals = values - center
+            if ccd_noise is not None:
+                sigma = ccd_noise(center)
+            elif iteration == 0:
+                sigma = 1.4826 * nan_median(numpy.abs(residuals), map_cube).data
+            else:
+                sigma = numpy.sqrt(numpy.nansum(residuals**2, axis=0, 
+                                   dtype=numpy.float64) / (map_cube - 1.))
+            residuals = original_values - center
+            rejected = ((residuals > hsigma * sigma) | 
+                        (residuals < -lsigma * sigma)) & (original_map >= 3)
+        new_mask = original_mask | rejected
+        if numpy.array_equal(new_mask, cube.mask):
+            break
+        cube.mask = new_mask
+
+def reject_minmax(cube, nlow, nhigh):
+    """ Reject (i.e. mask, in place) the nlow lowest and nhigh highest valid 
+        values of each pixel of the masked cube. Pixels with nlow + nhigh valid
+        values or less are left untouched. """
+    if nlow + nhigh >= cube.shape[0]:  # no pixel has enough values
+        return
+    map_cube = numpy.ma.count(cube, axis=0)
+    rejected = numpy.zeros(cube.shape, dtype=bool)
+    indicesx, indicesy = numpy.indices(map_cube.shape)
+    last = cube.shape[0] - 1
+    if nlow > 0:  # masked values go to the end, the lowest ones to the start
+        order = numpy.argpartition(cube.filled(numpy.inf), min(nlow-1, last),
+                                   axis=0)
+        rejected[order[:nlow], indicesx, indicesy] = True
+    if nhigh > 0:  # masked values go to the start, the highest ones to the end
+        order = numpy.argpartition(cube.filled(-numpy.inf), -min(nhigh, last),
+                                   axis=0)
+        rejected[order[-nhigh:], indicesx, indicesy] = True
+    rejected &= (map_cube > nlow + nhigh)
+    cube.mask |= rejected
+
+def reject_outliers(cube, scales, gains, readnoises, args):
+    """ Reject the outliers of the cube (e.g. cosmic rays, satellite trails) 
+        with the algorithm chosen by the user in args.reject. The scales, 
+        gains and readnoises (one per image) are needed by ccdclip, since the
+        noise of each image is calculated from the counts before scaling. 
+        Returns the number of pixels rejected in each of the images. """
+    if args.reject == "none":
+        return numpy.zeros(cube.shape[0], dtype=numpy.int64)
+    previous_mask = cube.mask.copy()
+    if args.reject == "sigclip":
+        clip_cube(cube, args.lsigma, args.hsigma, args.maxiters)
+    elif args.reject == "ccdclip":
+        scales = numpy.asarray(scales, dtype=numpy.float64).reshape(-1, 1, 1)
+        gains = numpy.asarray(gains, dtype=numpy.float64).reshape(-1, 1, 1)
+        readnoises = numpy.asarray(readnoises, dtype=numpy.float64).reshape(-1, 1, 1)
+        def ccd_noise(center):
+            counts = numpy.maximum(center * scales, 0)  # ADU before scaling
+            return numpy.sqrt((readnoises / gains)**2 + counts / gains) / scales
+        clip_cube(cube, args.lsigma, args.hsigma, args.maxiters, ccd_noise=ccd_noise)
+    elif args.reject == "minmax":
+        reject_minmax(cube, args.nlow, args.nhigh)
+    return (cube.mask & ~previous_mask).sum(axis=2).sum(axis=1)
+
+def value_or_keyword(input_images, value):
+    """ Parameters such as the gain can be given as a number or as the keyword
+        of the header that contains it. Return its value for each image. """
+    try:
+        return [float(value)] * len(input_images)
+    except ValueError:
+        return [float(x) for x in utils.collect_from_images(input_images, value)]
 
 ################################################################################
-def cube_images(input_images, mask_key, scales, limits=0):
+def cube_images(input_images, mask_key, scales, limits=0, readers=None,
+                dtype=numpy.float64):
     """ From a set of images (input_images), and once divided by their scales, 
-        form a cube with all the images. """
+        form a cube with all the images, with values of type dtype. If readers
+        (a utils.MaskedImageReader per image) are given, the images are read 
+        through them instead of opening the files again. """
     # Set the limits to build the piece of the cube
-    header = fits.getheader(input_images[0])
+    if readers:
+        header = readers[0].header
+    else:
+        header = header_index.get_header(input_images[0])
     if limits == 0:
         min_x, min_y = (0, 0)
         max_x, max_y = header["NAXIS2"], header["NAXIS1"]
@@ -49,37 +149,314 @@ def cube_images(input_images, mask_key, scales, limits=0):
     # Initialize the cube and the mask.
     lx, ly = max_x - min_x, max_y - min_y
     lz = len(input_images)
-    mask = numpy.zeros([lz,lx,ly])  # initialized to zero, all pixels are valid
+    mask = numpy.zeros([lz,lx,ly], dtype=dtype)  # initialized to zero, all pixels are valid
     cube = numpy.ma.array(mask, mask=mask) 
 
     # Now read all the images (and masks, if present), into the cube
     for index, image in enumerate(input_images):
-        im = utils.read_image_with_mask(image, mask_keyword = mask_key, limits=[min_x, min_y, max_x, max_y])
+        if readers:
+            im = readers[index].read([min_x, min_y, max_x, max_y], dtype=dtype)
+        else:
+            im = utils.read_image_with_mask(image, mask_keyword = mask_key, limits=[min_x, min_y, max_x, max_y],
+                                            dtype=dtype)
         cube.data[index,:,:] = im.data/scales[index]
         cube.mask[index,:,:] = im.mask
     return cube    
+
+################################################################################
+def open_readers(input_images, mask_key):
+    """ Open each image (and its mask) once, to read all the slices from them """
+    readers = []
+    try:
+        for image in input_images:
+            readers.append(utils.MaskedImageReader(image, mask_keyword=mask_key))
+    except:
+        close_readers(readers)
+        raise
+    return readers
+
+def close_readers(readers):
+    """ Close all the images and masks opened by open_readers """
+    for reader in readers:
+        reader.close()
+    
+################################################################################
+def rows_per_slice(input_images, mask_key, max_memory, jobs=1, reject="none",
+                   dtype=numpy.float64):
+    """ Number of rows of the images that can be combined at a time so that
+        the slices being processed (one per process) fit in max_memory bytes.
+        For every pixel of a row, each image contributes to the cube with a 
+        value of type dtype and a boolean mask, the median needs two more 
+        copies (see nan_median), rejecting outliers needs another three and
+        two boolean masks (see clip_cube), and reading the image needs the pixel 
+        of the image and the mask as stored in their files. """
+    ly, lx, bitpix = utils.get_from_header(input_images[0], "NAXIS1", "NAXIS2",
+                                           "BITPIX")
+    lz = len(input_images)
+    read_bytes = abs(bitpix) / 8
+    if mask_key:
+        try:
+            mask_name = utils.get_from_header(input_images[0], mask_key)
+            read_bytes += abs(utils.get_from_header(mask_name, "BITPIX")) / 8
+        except KeyError:  # mask in a MASK extension, 8 bits
+            read_bytes += 1
+    cube_bytes = 3 * numpy.dtype(dtype).itemsize + \
+                 numpy.dtype(numpy.bool_).itemsize
+    if reject != "none":
+        cube_bytes += 3 * numpy.dtype(dtype).itemsize + \
+                      2 * numpy.dtype(numpy.bool_).itemsize
+    row_bytes = ly * lz * (cube_bytes + read_bytes)
+    rows = int(max_memory / jobs / row_bytes)
+    if rows < 1:
+        print "Memory budget of " + str(max_memory) + " bytes is too small "+\
+              "to hold a single row of all the images. Using one row at a time."
+        rows = 1
+    return min(rows, lx)
     
 ################################################################################
-def compute_scales(input_images, scale_type, mask_key):
+def central_region(lx, ly):
+    """ Limits (min_x, min_y, max_x, max_y) of the central third of an image """
+    return [lx/3, ly/3, lx*2/3, ly*2/3]
+
+def scale_of(im, scale_type, image):
+    """ Scaling factor requested by the user (median, mean or none) of the 
+        masked array im, read from the image whose name is given. """
+    if scale_type == "median":
+        new_item = numpy.ma.median(im)
+    elif scale_type == "mean":  # summed in float64 even for float32 images
+        new_item = numpy.ma.mean(im, dtype=numpy.float64)
+    elif scale_type == "none":
+        new_item = 1
+    if new_item is numpy.ma.masked:  # Result if all elements where masked
+        new_item = 1
+        print ("All elements of the central part of image %s seem to be masked. "+\
+               "Replacing scale calculation by 1.") % image
+    return new_item
+
+def compute_scales(input_images, scale_type, mask_key, readers=None,
+                   dtype=numpy.float64):
     """ From the list of images, use the central third of the image to
-        calculate the scaling factor requested by user. """
-    lx, ly = fits.getdata(input_images[0]).shape
-    centre = [lx/3, ly/3, lx*2/3, ly*2/3]  # min_x, min_y, max_x, max_y
+        calculate the scaling factor requested by user. The size of the images
+        comes from the header. If readers (see open_readers) are given, the 
+        central third is read through them instead of opening the images. 
+        The images are read with values of type dtype. """
+    if scale_type == "none":
+        return [1] * len(input_images)
+    if readers:
+        lx, ly = readers[0].header["NAXIS2"], readers[0].header["NAXIS1"]
+    else:
+        lx, ly = utils.get_from_header(input_images[0], "NAXIS2", "NAXIS1")
+    centre = central_region(lx, ly)
     scales = []
-    for image in input_images:
-        im = utils.read_image_with_mask(image, mask_keyword=mask_key, limits=centre)
-        if scale_type == "median":
-            new_item = numpy.ma.median(im)
-        elif scale_type == "mean":
-            new_item = numpy.ma.mean(im)
-        elif scale_type == "none":
-            new_item = 1
-        if new_item is numpy.ma.masked:  # Result if all elements where masked
-            new_item = 1
-            print "All elements of the central part of image %s seem to be masked. "+\
-                  "Replacing scale calculation by 1." % image
-        scales.append(new_item)
-    return scales  # cases where of all elements were masked
+    for index, image in enumerate(input_images):
+        if readers:
+            im = readers[index].read(centre, dtype=dtype)
+        else:
+            im = utils.read_image_with_mask(image, mask_keyword=mask_key,
+                                            limits=centre, dtype=dtype)
+        scales.append(scale_of(im, scale_type, image))
+    return scales
+
+###################################################################################
+def combine_slice(readers, scales, limits, args, gains=None, readnoises=None):
+    """ Combine the piece of the images delimited by limits (min_x, min_y, 
+        max_x, max_y), reading them from readers (see open_readers). Returns 
+        the combined piece, its mask and the number of pixels rejected in 
+        each of the images (see reject_outliers). """
+    input_images = [reader.image for reader in readers]
+
+    # Now we can build a section of the cube with all the images
+    cube = cube_images(input_images, args.mask_key, scales, limits=limits,
+                       readers=readers, dtype=args.dtype)
+
+    # Reject outliers, if requested. They will be masked in the cube.
+    rejected = reject_outliers(cube, scales, gains, readnoises, args)
+
+    # Finally, average! The masked median of numpy is absurdly slow
+    # (https://github.com/numpy/numpy/issues/1811) and sorting the cube is
+    # not needed to find the median, so for the median the masked elements
+    # are replaced by NaN and the median is found by selection (nan_median).
+    map_cube = numpy.ma.count(cube, axis=0) # number non-masked values per pixel
+    # The mean is summed in float64 even if the cube is float32.
+    if args.average == "mean":
+        image = numpy.ma.mean(cube, axis=0, dtype=numpy.float64).astype(cube.dtype)
+    elif args.average == "median":
+        image = nan_median(cube.filled(numpy.nan), map_cube)
+
+    # Image is a masked array, we need to fill in masked values with the
+    # args.fill_val if user provided it. Also, values with less than
+    # args.nmin valid values should be masked out. If user did not provide
+    # a fill_val argument, we will substitute masked values with the
+    # unmasked equivalent operation, which is only needed for those pixels.
+    image.mask[map_cube < args.nmin] = 1
+    mask = image.mask
+    if args.fill_val != '':
+        image = image.filled(args.fill_val)
+    else:
+        if args.average == "mean":
+            non_masked_equivalent = numpy.mean(cube.data[:, mask], axis=0,
+                                               dtype=numpy.float64)
+        elif args.average == "median":
+            non_masked_equivalent = numpy.median(cube.data[:, mask], axis=0)
+        image.data[mask] = non_masked_equivalent
+        image = image.data
+    return image, mask, rejected
+
+# Images whose readers are open in this process (the main one or one of the 
+# pool, see --jobs), and the readers. Only one group of images is kept open.
+_open_images = None
+_open_readers = []
+
+def readers_for(input_images, mask_key):
+    """ Readers (see open_readers) of the images, opened only the first time
+        they are needed. The readers of a previous group of images are closed,
+        since the slices of a group are combined before the next one. """
+    global _open_images, _open_readers
+    if _open_images != input_images:
+        close_cached_readers()
+        _open_readers = open_readers(input_images, mask_key)
+        _open_images = list(input_images)
+    return _open_readers
+
+def close_cached_readers():
+    """ Close the readers opened by readers_for """
+    global _open_images, _open_readers
+    close_readers(_open_readers)
+    _open_images, _open_readers = None, []
+
+def _init_pool_process():
+    """ The readers opened in every process of the pool are closed when the 
+        process finishes, after pool.close() and pool.join(). """
+    multiprocessing.util.Finalize(None, close_cached_readers, exitpriority=10)
+
+def combine_task(task):
+    """ Combine a slice, task = (group, limits, args), of a group of images
+        (see plan_group). Returns the group and limits with the result of 
+        combine_slice, so that pieces of different groups can be told apart."""
+    group, limits, args = task
+    readers = readers_for(group["images"], args.mask_key)
+    piece = combine_slice(readers, group["scales"], limits, args, 
+                          gains=group["gains"], readnoises=group["readnoises"])
+    return group, limits, piece
+
+###################################################################################
+def plan_group(filt, list1, args):
+    """ Everything needed to combine a group of images (with the same filter)
+        slice by slice: scales of the images, gain and readout noise (for 
+        ccdclip), size of the images and the slices in which they are divided."""
+    readers = readers_for(list1, args.mask_key)
+    scales = compute_scales(list1, args.scale, args.mask_key, readers=readers,
+                            dtype=args.dtype)
+
+    # The noise model of ccdclip needs gain and readout noise
+    if args.reject == "ccdclip":
+        gains = value_or_keyword(list1, args.gain)
+        readnoises = value_or_keyword(list1, args.readnoise)
+    else:
+        gains, readnoises = None, None
+
+    # Get the sizes of the images
+    lx, ly = readers[0].header["NAXIS2"], readers[0].header["NAXIS1"]
+
+    # Now, in order to avoid loading many images in memory, we need to slice the images in pieces and combine a slice
+    # of all the images at a time. If the user gave a memory budget, the
+    # height of the slices is derived from it: since all the processes (one 
+    # per job) share it, whatever the group they are combining, the slices 
+    # of all the groups fit in it. Otherwise, divide the slow axis in n_slices
+    # pieces (the last one might be shorter).
+    n_slices = 32
+    if args.max_memory != "":
+        step = rows_per_slice(list1, args.mask_key,
+                              utils.memory_size_to_bytes(args.max_memory),
+                              jobs=args.jobs, reject=args.reject,
+                              dtype=args.dtype)
+    else:
+        step = int(math.ceil(lx / float(n_slices)))
+    slices = [[xmin, 0, min(xmin + step, lx), ly] for xmin in range(0, lx, step)]
+    return {"filter":filt, "images":list1, "scales":scales, "gains":gains,
+            "readnoises":readnoises, "shape":(lx, ly), "slices":slices}
+
+def group_tasks(groups, args):
+    """ Tasks for combine_task: the slices of each of the groups of images 
+        (filter, list of images). A group is planned (see plan_group) only 
+        when its first slice is needed. """
+    for filt, list1 in groups:
+        group = plan_group(filt, list1, args)
+        for limits in group["slices"]:
+            yield group, limits, args
+
+def write_group(group, whole_image, rejected, args, outdir, outfile):
+    """ Normalize (if requested) and write the combination of a group of 
+        images, and its mask. Returns the name of the new image. """
+    filt, list1 = group["filter"], group["images"]
+    lx, ly = group["shape"]
+
+    # To normalize calculate the scale of the central third of the result
+    # (as in compute_scales) and divide by it, before writing to disk.
+    if args.norm == True:
+        centre = central_region(lx, ly)
+        central_part = whole_image[centre[0]:centre[2], centre[1]:centre[3]]
+        if args.mask_key == "":
+            central_part = numpy.ma.array(central_part.data)
+        norm_value = scale_of(central_part, args.scale, outfile)
+        whole_image.data[:] = whole_image.data / norm_value
+        if args.fill_val != '':
+            whole_image.data[whole_image.mask] = float(args.fill_val)
+
+    # And save images. If all_together is activated, use the file name given by user. If not, we need
+    # to separate by filter, so compose a new name with the one given by the user adding the filter
+    if args.all_together:
+        newfile = args.output
+    else:
+        newfile = os.path.join(outdir, utils.add_suffix_prefix(outfile, suffix="_" + filt) )
+
+    # The number of pixels rejected in each image goes to the header
+    hdr = fits.Header()
+    if args.reject != "none":
+        hdr["NREJECT"] = (int(rejected.sum()), "Pixels rejected (" + 
+                          args.reject + ") while combining")
+        for image, n_rejected in zip(list1, rejected):
+            hdr.add_history(" - Rejected " + str(n_rejected) + 
+                            " pixels of image " + os.path.split(image)[1])
+    if args.norm == True:
+        hdr.add_history("- NORMALIZED USING MEDIAN VALUE: " + str(norm_value))
+    string1 = " - Image built from the combination of the images: "+\
+             ", ".join(list1)
+    string2 = " combine = " + args.average + ", scale = " + args.scale +\
+              ", reject = " + args.reject
+
+    # With --mef the mask goes, as 8 bits, in an extension of the image 
+    if args.mef:
+        if os.path.isfile(newfile):
+            os.remove(newfile)
+        hdr.add_history(string1 + string2)
+        hdr_mask = fits.Header()
+        hdr_mask.add_history(" - Mask of image: " + newfile)
+        utils.write_image_with_mask(newfile, whole_image.data, whole_image.mask,
+                                    header=utils.reserve_header_space(hdr),
+                                    mask_header=hdr_mask, 
+                                    compress=args.compress)
+        return newfile
+
+    if args.out_mask != "":
+        name_mask = args.out_mask
+    else:
+        name_mask = newfile + ".msk"
+    if os.path.isfile(newfile):
+        os.remove(newfile)
+    if os.path.isfile(name_mask):
+        os.remove(name_mask)
+
+    # Comments go in the headers before writing, so the files are written once
+    hdr.add_history(string1 + string2)
+    if args.mask_key != "":
+        hdr[args.mask_key] = (name_mask, "Mask for this image")
+    hdr_mask = fits.Header()
+    hdr_mask.add_history(" - Mask of image: " + newfile)
+    fits.writeto(newfile, whole_image.data, header=utils.reserve_header_space(hdr))
+    fits.writeto(name_mask, whole_image.mask.astype(numpy.int), header=hdr_mask)
+
+    return newfile
 
 ###################################################################################
 def combine(args):
@@ -101,102 +478,58 @@ def combine(args):
     # Create a default dictionary for the resulting images
     result = collections.defaultdict(str)    
     
-    # For each of the filters present combine the images (and write)
-    for filt in set(images_filters):
-        # list of objects with current filter (exception: allfilters is true)
+    # list of objects with each filter (exception: allfilters is true)
+    groups = []
+    for filt in sorted(set(images_filters)):
         list1 = [args.input[p] for p,f in enumerate(images_filters) if f == filt ]
 
         # Check that all images have same dimension. If not, exit program
         if not utils.check_dimensions(list1):
             sys.exit("Dimensions of images to combine are different!")
-
-        # Calculate scale of images
-        scales = compute_scales(list1, args.scale, args.mask_key)
-
-
-        # Get the sizes of the images
-        lx, ly = utils.get_from_header(list1[0], "NAXIS2", "NAXIS1")
-
-        # Now, in order to avoid loading many images in memory, we need to slice the images in pieces and combine a slice
-        # of all the images at a time
-        n_slices = 32          # divide the slow axis in this many pieces
-
-        # Define the whole image and set all elements of mask to False
-        whole_image = numpy.ma.zeros([lx,ly])
-        whole_image.mask = numpy.zeros_like(whole_image.data)
-
-        for xmin in range(0, lx, lx/n_slices):
-            xmax = min(xmin + lx/n_slices, lx)
-
-            # Now we can build and sort a section of the cube with all the images
-            cube = cube_images(list1, args.mask_key, scales, limits=[xmin, 0, xmax, ly])
-            cube.sort(axis=0)
-
-            # Finally, average! Remember that the cube is sorted so that
-            # cube[0,ii,jj] < cube[1,ii,jj] and that the highest values of all
-            # are the masked elements. We will take advantage of it if the median
-            # is selected, because nowadays the masked median is absurdly slow:
-            # https://github.com/numpy/numpy/issues/1811
-            map_cube = numpy.ma.count(cube, axis=0) # number non-masked values per pixel
-            if args.average == "mean":
-                image = numpy.ma.mean(cube, axis=0)
-                non_masked_equivalent = numpy.mean(cube.data, axis=0)
-            elif args.average == "median":
-                image = home_made_median(map_cube, cube)
-                non_masked_equivalent = numpy.median(cube.data, axis=0)
-
-            # Image is a masked array, we need to fill in masked values with the
-            # args.fill_val if user provided it. Also, values with less than
-            # args.nmin valid values should be masked out. If user did not provide
-            # a fill_val argument, we will substitute masked values with the
-            # unmasked equivalent operation.
-            image.mask[map_cube < args.nmin] = 1
-            mask = image.mask
-            if args.fill_val != '':
-                image = image.filled(args.fill_val)
-            else:
-                image.data[mask == True] = non_masked_equivalent[mask == True]
-                image = image.data
-
-            whole_image.data[xmin:xmax, 0:ly] = image[:,:]
-            whole_image.mask[xmin:xmax, 0:ly] = mask[:,:]
-
-        # And save images. If all_together is activated, use the file name given by user. If not, we need
-        # to separate by filter, so compose a new name with the one given by the user adding the filter
-        if args.all_together:
-            newfile = args.output
+        groups.append((filt, list1))
+
+    # The slices of all the filters are independent of each other, so if the
+    # user asked for it with --jobs they are combined in parallel by a single
+    # pool of processes, which moves on to the slices of the next filter as 
+    # soon as a process is free instead of waiting for the current filter to
+    # be finished and written. The pieces arrive in order, so each filter is 
+    # written as soon as all its slices have been combined.
+    pool = None
+    try:
+        if args.jobs > 1:
+            tasks = list(group_tasks(groups, args))
+            close_cached_readers()  # the processes of the pool open their own
+            pool = multiprocessing.Pool(processes=args.jobs,
+                                        initializer=_init_pool_process)
+            pieces = pool.imap(combine_task, tasks)
         else:
-            newfile = os.path.join(outdir, utils.add_suffix_prefix(outfile, suffix="_" + filt) )
+            pieces = (combine_task(task) for task in group_tasks(groups, args))
+
+        in_progress = {}
+        for group, limits, (image, mask, rejected_slice) in pieces:
+            filt = group["filter"]
+            if filt not in in_progress:
+                # Define the whole image and set all elements of mask to False
+                whole_image = numpy.ma.zeros(group["shape"], dtype=args.dtype)
+                whole_image.mask = numpy.zeros(group["shape"], dtype=bool)
+                rejected = numpy.zeros(len(group["images"]), dtype=numpy.int64)
+                in_progress[filt] = [whole_image, rejected, 0]
+            whole_image, rejected, n_done = in_progress[filt]
+            xmin, ymin, xmax, ymax = limits
+            whole_image.data[xmin:xmax, ymin:ymax] = image[:,:]
+            whole_image.mask[xmin:xmax, ymin:ymax] = mask[:,:]
+            rejected += rejected_slice
+            in_progress[filt][2] = n_done + 1
+            if n_done + 1 == len(group["slices"]):
+                del in_progress[filt]
+                result[filt] = write_group(group, whole_image, rejected, args, 
+                                           outdir, outfile)
+    finally:
+        close_cached_readers()
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-        if args.out_mask != "":
-            name_mask = args.out_mask
-        else:
-            name_mask = newfile + ".msk"
-        if os.path.isfile(newfile):
-            os.remove(newfile)
-        if os.path.isfile(name_mask):
-            os.remove(name_mask)
-        fits.writeto(newfile, whole_image.data)
-        fits.writeto(name_mask, whole_image.mask.astype(numpy.int))
-        result[filt] = newfile
-
-        # Add comments to the headers
-        string1 = " - Image built from the combination of the images: "+\
-                 ", ".join(list1)
-        string2 = " combine = " + args.average + ", scale = " + args.scale
-        utils.add_history_line(newfile, string1 + string2 )
-        utils.add_history_line(name_mask, " - Mask of image: " + newfile)
-        if args.mask_key != "":
-            utils.header_update_keyword(newfile, args.mask_key, name_mask,
-                                        "Mask for this image")
-
-        # To normalize calculate median and call arith_images to divide by it.
-        if args.norm == True:
-            median = compute_scales([newfile], args.scale, args.mask_key)[0]
-            msg =  "- NORMALIZED USING MEDIAN VALUE:"
-            arith_images.main(arguments=["--message", msg, "--output", newfile,
-                                         "--mask_key", args.mask_key, "--fill_val",
-                                         args.fill_val, newfile, "/", str(median)])
     return result
 
 ############################################################################
@@ -225,6 +558,36 @@ parser.add_argument("--nmin", metavar="nmin", type=int, dest="nmin", action='sto
                     "(i.e. non masked, non rejected) pixels. If the valid pixels "+\
                     "are less than nmin, the fill_val value is used as result, "+\
                     "and the pixel is masked. Default: 1.")
+parser.add_argument("--reject", metavar="reject", dest="reject", \
+                    action='store', default="none", choices=["none", "sigclip",
+                    "ccdclip", "minmax"], help="Algorithm to reject outliers "+\
+                    "(e.g. cosmic rays, satellite trails) before combining: "+\
+                    "none, sigclip (iterative sigma clipping around the median), "+\
+                    "ccdclip (same, but sigma from the --gain and --readnoise of "+\
+                    "the CCD) or minmax (reject the --nlow lowest and --nhigh "+\
+                    "highest values of each pixel). Default: none")
+parser.add_argument("--lsigma", metavar="lsigma", dest="lsigma", type=float, \
+                    action='store', default=3., help="Lower sigma clipping "+\
+                    "factor for sigclip and ccdclip. Default: 3")
+parser.add_argument("--hsigma", metavar="hsigma", dest="hsigma", type=float, \
+                    action='store', default=3., help="Upper sigma clipping "+\
+                    "factor for sigclip and ccdclip. Default: 3")
+parser.add_argument("--maxiters", metavar="maxiters", dest="maxiters", type=int, \
+                    action='store', default=5, help="Maximum number of "+\
+                    "iterations of sigclip and ccdclip. Default: 5")
+parser.add_argument("--nlow", metavar="nlow", dest="nlow", type=int, \
+                    action='store', default=1, help="Number of low values "+\
+                    "rejected by minmax. Default: 1")
+parser.add_argument("--nhigh", metavar="nhigh", dest="nhigh", type=int, \
+                    action='store', default=1, help="Number of high values "+\
+                    "rejected by minmax. Default: 1")
+parser.add_argument("--gain", metavar='gain', action='store', dest='gain',\
+                    default='2', help="Gain (either value or keyword from the "+\
+                    "header) of the telescope in e-/ADU, used by ccdclip. Default: 2")
+parser.add_argument("--readnoise", metavar="readout noise", action='store', \
+                    dest='readnoise', default="5", help="Readout noise of the "+\
+                    "telescope (value or header keyword) in e-, used by ccdclip. "+\
+                    "Default: 5")
 parser.add_argument("--filterk", action="store", dest="filterk", default='filter', \
                     help="Keyword in the header that contains the name of "+\
                     "the filter. Alternatively you can provide the filter "+\
@@ -237,6 +600,33 @@ parser.add_argument("--output_mask", metavar="output_mask", dest='out_mask', \
                     action='store', default="", help=' Name of the output mask. '
                     'If none is provided, the program will add .msk '+\
                     'to the output name ( output.fits is the name of the output image. ')
+parser.add_argument("--mef", action="store_true", dest="mef", default=False, \
+                    help=' Write the mask as an 8 bits extension (MASK) of the '+\
+                    'output image instead of a separate file. It is read by '+\
+                    'utilities.read_image_with_mask with no need of --mask_key. '+\
+                    'Default: No')
+parser.add_argument("--compress", action="store_true", dest="compress", \
+                    default=False, help=' Tile compress the MASK extension '+\
+                    'written with --mef. Default: No')
+parser.add_argument("--max_memory", metavar="max_memory", dest="max_memory", \
+                    action='store', default="", help=' Maximum memory (e.g. '+\
+                    '"2GB", "512MB") to be used while combining. The number of '+\
+                    'rows of the images combined at a time is calculated from '+\
+                    'it, the number of images and the size of their pixels. '+\
+                    'If not present, the images are divided in 32 slices.')
+parser.add_argument("--jobs", metavar="jobs", dest="jobs", type=int, \
+                    action='store', default=1, help=' Number of processes '+\
+                    'used to combine the slices of the images in parallel. '+\
+                    'The slices of all the filters share the processes (and '+\
+                    'the --max_memory). The result is identical to the one of '+\
+                    'a single process. '+\
+                    'Default: 1.')
+parser.add_argument("--dtype", metavar="dtype", dest="dtype", action='store', \
+                    default="float64", choices=["float64", "float32"], \
+                    help=' Type of the values used to combine the images and '+\
+                    'to write the result. float32 is enough for 16 bits raw '+\
+                    'images and halves the memory (and disk) needed. Means are '+\
+                    'always summed in float64. Default: float64')
 parser.add_argument("--fill_val", metavar="fill_val", dest="fill_val", \
                     action='store', default='', help=' If present, this '+\
                     'keyword contains a value that substitutes the result '+\
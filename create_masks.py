@@ -39,13 +39,65 @@ def zero_edges(image, edge=5):
     image[:, image.shape[1]-edge:] = 0.
     return image    
 
+def sobel_at(image, x, y):
+    """ Magnitude of the Sobel filter of the image (as apply_sobel_filter) 
+        only at the pixels (x, y) """
+    lx, ly = image.shape
+    rows = [numpy.clip(x + dd, 0, lx - 1) for dd in (-1, 0, 1)]
+    cols = [numpy.clip(y + dd, 0, ly - 1) for dd in (-1, 0, 1)]
+    weights = [1., 2., 1.]
+    dx = sum(ww * (image[rows[2], cc] - image[rows[0], cc]) 
+             for ww, cc in zip(weights, cols))
+    dy = sum(ww * (image[rr, cols[2]] - image[rr, cols[0]]) 
+             for ww, rr in zip(weights, rows))
+    return numpy.hypot(dx, dy)
+
+def annulus_pixels(shape, xc, yc, radius, width, edge=0):
+    """ Indices (x, y) of the pixels of an image of the given shape, but not
+        within edge pixels of its borders, that are less than width away from
+        the circle of centre (xc, yc) and radius, without going through all
+        the pixels of the image. """
+    lx, ly = shape
+    x_all, y_all = [], []
+    for x in range(max(edge, int(xc - radius - width)), 
+                   min(lx - edge, int(xc + radius + width) + 2)):
+        outer = (radius + width)**2 - (x - xc)**2
+        if outer <= 0:
+            continue
+        outer = numpy.sqrt(outer)
+        inner = (radius - width)**2 - (x - xc)**2
+        if inner > 0:  # two arcs in this row
+            inner = numpy.sqrt(inner)
+            ranges = [(yc - outer, yc - inner), (yc + inner, yc + outer)]
+        else:
+            ranges = [(yc - outer, yc + outer)]
+        for ymin, ymax in ranges:
+            y = numpy.arange(max(edge, int(numpy.ceil(ymin))), 
+                             min(ly - edge, int(numpy.floor(ymax)) + 1))
+            x_all.append(numpy.ones(len(y), dtype=int) * x)
+            y_all.append(y)
+    if not x_all:
+        return numpy.array([], dtype=int), numpy.array([], dtype=int)
+    return numpy.concatenate(x_all), numpy.concatenate(y_all)
+
+def downsample(image, factor):
+    """ Average of blocks of factor x factor pixels of the image (the last 
+        rows and columns are left out if the shape is not a multiple) """
+    lx, ly = image.shape[0] / factor, image.shape[1] / factor
+    blocks = image[:lx * factor, :ly * factor].reshape(lx, factor, ly, factor)
+    return blocks.mean(axis=3).mean(axis=1)
+
 def detect_circular_FoV(data, args):
     ''' A Sobel edge detection algorithm is used to detect a sharp circular edge 
         within a rectangular 2D numpy array. The array is the only input, while
         the centre of the image and the radius of the circle are provided as 
-        outputs.     
+        outputs. The edge is first detected in the image downsampled by 
+        args.downsample, and the circle is then refined with the pixels of the
+        full image around that first one.
     '''
-    mag = apply_sobel_filter(data)  # Filter image
+    factor = args.downsample
+    small = downsample(data, factor) if factor > 1 else data
+    mag = apply_sobel_filter(small)  # Filter image
 
     # Exclude edges of image. Sobel uses a filter of size 3.  
     mag = zero_edges(mag, edge=3)
@@ -66,19 +118,54 @@ def detect_circular_FoV(data, args):
 #    fits.writeto("fitted_points.fits", fitted_points )
 
 
-    # If radius_MAD > 5% of the radius, data was not originally a circle
-    if (radius_MAD / radius * 100) < 5:
-        result = xc, yc, radius 
-    else:
-        result = None
-    return result
+    # If radius_MAD > 5% of the radius, data was not originally a circle. 
+    # (Checked before the refinement, whose points are all near the circle)
+    if (radius_MAD / radius * 100) >= 5:
+        return None
+
+    # Back to the pixels of the full image, and refine the fit with the 
+    # sharpest edge among the pixels within 2 (small) pixels of the circle
+    if factor > 1:
+        xc, yc = xc * factor + (factor - 1) / 2., yc * factor + (factor - 1) / 2.
+        radius = radius * factor
+        x, y = annulus_pixels(data.shape, xc, yc, radius, 2 * factor, edge=3)
+        mag = sobel_at(data, x, y)
+        n_points = int(round(data.size * (100 - args.contrast) / 100.))
+        if 0 < n_points < len(mag):
+            sharpest = numpy.argsort(mag)[-n_points:]
+            x, y = x[sharpest], y[sharpest]
+        if len(x) > 3:
+            xc, yc, radius = fit_to_circle(x, y, xc, yc)[:3]
+    return xc, yc, radius
+
+def check_circular_FoV(data, xc, yc, radius):
+    """ Cheap check that a circle (e.g. fitted to another image of the same 
+        instrument) is the edge of the FoV of this image: just inside the 
+        circle the image must be clearly brighter than just outside it """
+    lx, ly = data.shape
+    width = max(3., 0.02 * radius)
+    angles = numpy.linspace(0, 2 * numpy.pi, 360, endpoint=False)
+    xin, yin, xout, yout = [numpy.round(centre + rr * trig(angles)).astype(int)
+                            for rr in (radius - width, radius + width)
+                            for centre, trig in ((xc, numpy.cos), (yc, numpy.sin))]
+    valid = (xin >= 0) & (xin < lx) & (yin >= 0) & (yin < ly) & \
+            (xout >= 0) & (xout < lx) & (yout >= 0) & (yout < ly)
+    if valid.sum() < 36:  # less than 1/10 of the circle in the image
+        return False
+    inside = data[xin[valid], yin[valid]]
+    outside = data[xout[valid], yout[valid]]
+    noise = 1.4826 * numpy.median(numpy.abs(outside - numpy.median(outside)))
+    contrast = numpy.median(inside) - numpy.median(outside)
+    return contrast > 0 and contrast > 5 * noise
 
 def fit_to_circle(x, y, xc=None, yc=None):
     """ Fit to a circle using a variant from the method shown by the scipy 
         cookbook:
         http://wiki.scipy.org/Cookbook/Least_Squares_Circle """
-    if not xc:
+    if xc is None or yc is None:
         estimate = numpy.median(x), numpy.median(y)  # first guess for centre
+    else:
+        estimate = xc, yc
 
     ii = 0
     # until convergence
@@ -129,6 +216,10 @@ def mask_circle(image, xc, yc, radius, value=0):
     image[numpy.where(r > radius)] = value
     return image
 
+# Circles of the FoV fitted so far, {(values of the keywords of --fov_keys,
+# shape of the image): (xc, yc, radius)}
+_fitted_FoVs = {}
+
 def mask(args):
     ''' Program to mask a set of images according to:
            - min, max clipping
@@ -145,9 +236,18 @@ def mask(args):
         header = im[0].header
         mask = numpy.ones(data.shape, dtype=numpy.int) * args.true_val #create mask
         
-        # If circular field of view within rectangular image:
+        # If circular field of view within rectangular image. The circle of
+        # the previous images of the same instrument, binning and shape is 
+        # used, unless it does not pass a quick check on this image.
         if args.circular:
-            result = detect_circular_FoV(data, args)
+            key = tuple(header.get(keyword) for keyword in args.fov_keys) +\
+                  data.shape
+            result = _fitted_FoVs.get(key)
+            if args.refit or result is None or \
+               not check_circular_FoV(data, *result):
+                result = detect_circular_FoV(data, args)
+                if result:
+                    _fitted_FoVs[key] = result
             if result:
                 xc, yc, radius = result
                 radius = radius - args.margin   # avoid border effects
@@ -232,6 +332,21 @@ parser.add_argument("--circular", action="store_true", dest="circular", \
                    default=False, help=' Use if the field of view is circular, '+\
                    ' while the image is a rectangle. Mask is set to zero_value '+\
                    'the circle. ')
+parser.add_argument("--refit", action="store_true", dest="refit", \
+                   default=False, help=' With --circular, fit the circle of '+\
+                   'every image, instead of using the one of the previous '+\
+                   'images of the same instrument and binning. ')
+parser.add_argument("--fov_keys", metavar="fov_keys", dest="fov_keys", \
+                    nargs="+", default=["TELESCOP", "INSTRUME", "CCDSUM"], \
+                    help='Keywords of the header that identify the instrument '+\
+                    'and binning. With --circular, images with the same values '+\
+                    'and shape share the circle of the field of view. Default: '+\
+                    'TELESCOP INSTRUME CCDSUM')
+parser.add_argument("--downsample", metavar="downsample", dest="downsample", \
+                    default=4, type=int, action='store', help='With --circular, '+\
+                    'the edge of the field of view is first detected in the '+\
+                    'image downsampled by this factor, then refined in the '+\
+                    'full image. Default: 4')
 parser.add_argument("--stars", action="store_true", dest="stars", \
                    default=False, help=' Use if you want to mask stars in '+\
                    ' an image. ')                  
@@ -14,6 +14,7 @@ Created on Mon Oct 28 23:14:24 2013
 @author: blasco
 """
 import repipy.utilities as utilities
+import repipy.catalogues as catalogues
 import numpy as np
 import pyraf.iraf as iraf
 import astropy.io.fits as fits  
@@ -64,8 +65,8 @@ def calculate_seeing(args):
                    FWHM = np.append(FWHM, float(line.split()[3]))
                 except:
                    pass 
-        xin, yin = np.genfromtxt(im_cat, dtype="float", unpack=True)
-        xin, yin = np.array(xin), np.array(yin)  # case it is only one value
+        stars = catalogues.read_columns(im_cat)
+        xin, yin = stars["col0"], stars["col1"]
 
 
         # If args.wcs is "world" it means the input is in (RA, DEC), while 
@@ -117,10 +118,8 @@ def calculate_seeing(args):
         # stars to the im_cat file. 
         median_fwhm = np.median(FWHM)
         utilities.header_update_keyword(im, "seeing", median_fwhm, "FWHM of image")
-        f = open(im_cat, 'w') # write the "good" stars in the catalogue
-        for ii in range(len(xout)):
-            f.write(str(xout[ii]) + "  " + str(yout[ii]) + "\n")
-        f.close()
+        # write the "good" stars in the catalogue
+        catalogues.write_columns(im_cat, [xout, yout], delimiter="  ")
 
         # And clean after yourself!
         utilities.if_exists_remove("q.txt", output, ignore)
@@ -1,84 +1,343 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
-import scipy
 import numpy
 import astropy.io.fits as fits
 import os
 import sys
 import argparse
+import multiprocessing
 from scipy.optimize import curve_fit
-from matplotlib import pyplot
+from scipy import ndimage
+from scipy.interpolate import RectBivariateSpline
+import repipy.utilities as utils
 
 """ This program estimates the sky in a fits image, by assuming that the mode
-of the image represents the sky. It also estimates de standard deviation of 
-the sky pixels and introduces the relevant keywords in the header of the 
-image. Finally, it adds a "history" line to the header.  """
+of the image represents the sky. It also estimates de standard deviation of
+the sky pixels and introduces the relevant keywords in the header of the
+image. Finally, it adds a "history" line to the header.
+
+The sky can be estimated with three methods (--method):
+  - fit: Gaussian fit to the peak of the histogram of the image (default)
+  - histogram: mode of the (smoothed) histogram, and the standard deviation
+    from the median absolute deviation (MAD) of the pixels around it
+  - clip: mode (2.5 median - 1.5 mean) and MAD of the pixels that survive an
+    iterative 3 sigma clipping
+The histograms only cover a window around a first robust estimate, from a
+subsample of the pixels, so they do not depend on the range of the image.
+
+With --mesh the sky is also mapped in two dimensions, as SExtractor does: the
+image is divided in boxes of mesh x mesh pixels, the sky and its standard
+deviation of each box are estimated with sigma clipping, the mesh is median
+filtered (--filter_size boxes) and interpolated back to every pixel with
+bicubic splines. The background and RMS maps are written as FITS images (with
+suffixes -bkg and -rms), and sky and sky_std are then their median values. The
+cost grows linearly with the pixels, so the map is a cheap replacement for the
+median filtering of images with large radii. """
+
+# Pixels used for the first estimate of the sky, and width of the window of
+# the histogram around it (in standard deviations)
+n_subsample = 100000
+window = 5.
+
+# Minimum fraction of valid (not masked) pixels of a box of the mesh. Boxes
+# with less take the values of the nearest valid box.
+min_valid_fraction = 0.5
 
 def gauss(x, *p):
     A,mu,sigma,cont = p
-    return cont + A*numpy.exp(-(x-mu)**2/(2.*sigma**2))    
+    return cont + A*numpy.exp(-(x-mu)**2/(2.*sigma**2))
 
-def find_sky(args):
+def robust_guess(values):
+    """ Median and standard deviation (from the MAD) of a subsample of the
+        values, a first estimate of the sky """
+    sample = values[::max(1, len(values) / n_subsample)]
+    median = numpy.median(sample)
+    sigma = 1.4826 * numpy.median(numpy.abs(sample - median))
+    if sigma == 0:  # e.g. most pixels with the same value
+        sigma = max(numpy.std(sample), 1.)
+    return median, sigma
+
+def histogram(values, centre, sigma):
+    """ Histogram, with numpy.bincount, of the values within window sigmas of
+        centre. Bins are sigma/10 wide, or whole ADUs for images of integer
+        values (so that all bins can hold the same number of values), with
+        edges half an ADU below the integers, so that the centre of a bin is
+        the mean of the values it holds. Returns the number of values and the
+        centre of each bin. """
+    width = sigma / 10.
+    sample = values[::max(1, len(values) / n_subsample)]
+    low = 0.
+    if numpy.mean(numpy.mod(sample, 1) == 0) > 0.9:  # (mostly) integer ADUs
+        width = max(1., numpy.round(width))
+        low = -0.5
+    low += numpy.floor((centre - window * sigma) / width) * width
+    nbins = int(numpy.ceil(2 * window * sigma / width)) + 1
+    indices = numpy.floor((values - low) / width).astype(numpy.int64)
+    indices = indices[(indices >= 0) & (indices < nbins)]
+    counts = numpy.bincount(indices, minlength=nbins)
+    return counts, low + (numpy.arange(nbins) + 0.5) * width
+
+def sky_histogram(values):
+    """ Mode of the histogram of the values, and the standard deviation
+        (from the MAD) of the values within the window around it """
+    centre, sigma = robust_guess(values)
+    counts, bincenters = histogram(values, centre, sigma)
+    counts = numpy.convolve(counts, numpy.ones(5) / 5., mode="same")  # smooth
+    maxpos = counts.argmax()
+    mode = bincenters[maxpos]
+    # Vertex of the parabola through the maximum and the bins next to it
+    if 0 < maxpos < len(counts) - 1:
+        left, top, right = counts[maxpos - 1:maxpos + 2]
+        if left - 2 * top + right != 0:
+            mode += 0.5 * (left - right) / (left - 2 * top + right) * \
+                    (bincenters[1] - bincenters[0])
+    near = values[numpy.abs(values - mode) < window * sigma]
+    std = 1.4826 * numpy.median(numpy.abs(near - mode))
+    return mode, std
+
+def sky_clip(values, nsigma=3., iterations=10):
+    """ Mode (2.5 median - 1.5 mean) and standard deviation (from the MAD) of
+        the values left after clipping, iteratively, those nsigma away from
+        the median """
+    for ii in range(iterations):
+        median = numpy.median(values)
+        std = 1.4826 * numpy.median(numpy.abs(values - median))
+        keep = numpy.abs(values - median) < nsigma * std
+        if keep.all() or std == 0:
+            break
+        values = values[keep]
+    mean = numpy.mean(values)
+    # The estimator of the mode only works for moderately skewed values
+    if std > 0 and abs(mean - median) / std < 0.3:
+        return 2.5 * median - 1.5 * mean, std
+    return median, std
+
+def sky_fit(values):
+    """ Centre and width of a Gaussian fitted to the peak of the histogram of
+        the values, the bins within 3 sigma of the maximum """
+    centre, sigma = robust_guess(values)
+    counts, bincenters = histogram(values, centre, sigma)
+    maxpos = counts.argmax()
+    peak = numpy.abs(bincenters - bincenters[maxpos]) < 3 * sigma
+    p0 = [counts[maxpos], bincenters[maxpos], sigma, 0.]
+    coeff, varmatrix = curve_fit(gauss, bincenters[peak], counts[peak], p0=p0)
+    return coeff[1], abs(coeff[2]), (bincenters, counts, coeff)
+
+def estimate_sky(data, mask=None, method="fit"):
+    """ Sky value and its standard deviation for the pixels of data not
+        masked (mask different from 0), with one of the methods: fit,
+        histogram or clip """
+    values = numpy.asarray(data, dtype=numpy.float64)
+    if mask is not None:
+        values = values[numpy.asarray(mask) == 0]
+    values = values[numpy.isfinite(values)].ravel()
+    if method == "fit":
+        return sky_fit(values)[:2]
+    elif method == "histogram":
+        return sky_histogram(values)
+    elif method == "clip":
+        return sky_clip(values)
+    raise ValueError("Unknown method to estimate the sky: " + method)
+
+def mesh_statistics(blocks, nsigma=3., iterations=10):
+    """ Sky and standard deviation of each box of the mesh, the last axis of
+        blocks, with invalid pixels as nan. The values of each box are sorted
+        once: the values within nsigma of the median are then a range of the
+        sorted values, and the median, mean and standard deviation of that
+        range come from its limits and cumulative sums, for all the boxes at
+        once. The sky is the mode (2.5 median - 1.5 mean), or the median if
+        the values are too skewed, as in SExtractor. Returns the sky, the
+        standard deviation and the number of valid pixels of each box. """
+    blocks = numpy.sort(blocks, axis=-1)  # nan go to the end
+    nvalid = numpy.isfinite(blocks).sum(axis=-1)
+    lo, hi = numpy.zeros_like(nvalid), nvalid.copy()
+    def middle(lo, hi):
+        """ Median of the values between the indices lo and hi of each box """
+        low = numpy.maximum(lo + (hi - lo - 1) / 2, 0)[..., None]
+        high = numpy.maximum(lo + (hi - lo) / 2, 0)[..., None]
+        return 0.5 * (numpy.take_along_axis(blocks, low, -1) +
+                      numpy.take_along_axis(blocks, high, -1))[..., 0]
+    # Cumulative sums relative to the first median, to keep their precision
+    zero = numpy.where(nvalid > 0, middle(lo, hi), 0.)
+    values = numpy.where(numpy.isfinite(blocks), blocks - zero[..., None], 0.)
+    sums = numpy.concatenate([numpy.zeros(nvalid.shape + (1,)),
+                              numpy.cumsum(values, axis=-1)], axis=-1)
+    squares = numpy.concatenate([numpy.zeros(nvalid.shape + (1,)),
+                                 numpy.cumsum(values**2, axis=-1)], axis=-1)
+    def moments(lo, hi):
+        """ Mean and standard deviation of the values between lo and hi """
+        n = numpy.maximum(hi - lo, 1)
+        total = numpy.take_along_axis(sums, hi[..., None], -1) - \
+                numpy.take_along_axis(sums, lo[..., None], -1)
+        total2 = numpy.take_along_axis(squares, hi[..., None], -1) - \
+                 numpy.take_along_axis(squares, lo[..., None], -1)
+        mean = total[..., 0] / n
+        return mean + zero, numpy.sqrt(numpy.maximum(total2[..., 0] / n - mean**2, 0))
+    with numpy.errstate(invalid="ignore"):  # boxes without valid pixels
+        for ii in range(iterations):
+            median = middle(lo, hi)
+            mean, std = moments(lo, hi)
+            # Indices of the first value above median - nsigma std and of the
+            # first one above median + nsigma std (nan are never counted)
+            new_lo = (blocks < (median - nsigma * std)[..., None]).sum(axis=-1)
+            new_hi = (blocks <= (median + nsigma * std)[..., None]).sum(axis=-1)
+            if (new_lo == lo).all() and (new_hi == hi).all():
+                break
+            lo, hi = new_lo, numpy.maximum(new_hi, new_lo)
+        median = middle(lo, hi)
+        mean, std = moments(lo, hi)
+        skewed = numpy.abs(mean - median) >= 0.3 * std
+        sky = numpy.where(skewed, median, 2.5 * median - 1.5 * mean)
+    return sky, std, nvalid
+
+def fill_mesh(values, valid):
+    """ Give the boxes of the mesh that are not valid the values of the 
+        nearest valid box """
+    if not valid.any():
+        raise ValueError("No box of the mesh has enough valid pixels")
+    indices = ndimage.distance_transform_edt(~valid, return_distances=False,
+                                             return_indices=True)
+    return values[tuple(indices)]
+
+def interpolate_mesh(mesh, box, shape):
+    """ Bicubic spline through the values of the mesh, at the centres of the
+        boxes of box x box pixels, evaluated at every pixel of an image of
+        the given shape. Meshes with less than four boxes along an axis use 
+        splines of lower degree. """
+    centres, degrees = [], []
+    for axis, size in enumerate(shape):
+        starts = numpy.arange(0, size, box)
+        centres.append((starts + numpy.minimum(starts + box, size) - 1) / 2.)
+        if len(starts) == 1:  # a constant, through both edges of the image
+            centres[-1] = numpy.array([0., size - 1.])
+            mesh = numpy.repeat(mesh, 2, axis=axis)
+        degrees.append(min(3, len(centres[-1]) - 1))
+    spline = RectBivariateSpline(centres[0], centres[1], mesh, kx=degrees[0],
+                                 ky=degrees[1], s=0,
+                                 bbox=[0, shape[0] - 1, 0, shape[1] - 1])
+    return spline(numpy.arange(shape[0]), numpy.arange(shape[1]))
+
+def background_map(data, mask=None, box=64, filter_size=3):
+    """ Background and RMS maps of the image: sky and standard deviation of 
+        the boxes of box x box pixels of a mesh, median filtered (over 
+        filter_size x filter_size boxes) and interpolated to every pixel.
+        Pixels masked (mask different from 0) are ignored. """
+    values = numpy.array(data, dtype=numpy.float64)
+    if mask is not None:
+        values[numpy.asarray(mask) != 0] = numpy.nan
+    values[~numpy.isfinite(values)] = numpy.nan
+    # Pad the image with nan to a whole number of boxes, and make the pixels
+    # of each box the last axis
+    ny, nx = values.shape
+    nmy, nmx = -(-ny // box), -(-nx // box)
+    padded = numpy.empty((nmy * box, nmx * box))
+    padded.fill(numpy.nan)
+    padded[:ny, :nx] = values
+    blocks = padded.reshape(nmy, box, nmx, box).swapaxes(1, 2).reshape(nmy, nmx, -1)
+    sky, std, nvalid = mesh_statistics(blocks)
+    # Pixels of each box inside the image, for the boxes at the edges
+    inside = numpy.outer(numpy.minimum(ny - numpy.arange(nmy) * box, box),
+                         numpy.minimum(nx - numpy.arange(nmx) * box, box))
+    valid = nvalid >= min_valid_fraction * inside
+    sky, std = fill_mesh(sky, valid), fill_mesh(std, valid)
+    if filter_size > 1:
+        sky = ndimage.median_filter(sky, size=filter_size, mode="nearest")
+        std = ndimage.median_filter(std, size=filter_size, mode="nearest")
+    return interpolate_mesh(sky, box, (ny, nx)), interpolate_mesh(std, box, (ny, nx))
+
+def map_names(image):
+    """ Names of the files of the background and RMS maps of an image """
+    return utils.add_suffix_prefix(image, suffix="-bkg"), \
+           utils.add_suffix_prefix(image, suffix="-rms")
+
+def plot_fit(data, mask=None):
+    """ Plot the histogram of the image and the Gaussian fit to its peak.
+        matplotlib is only needed (and imported) to plot. """
+    from matplotlib import pyplot
+    values = numpy.asarray(data, dtype=numpy.float64)
+    if mask is not None:
+        values = values[numpy.asarray(mask) == 0]
+    values = values[numpy.isfinite(values)].ravel()
+    bincenters, counts, coeff = sky_fit(values)[2]
+    pyplot.plot(bincenters, counts, 'o')
+    pyplot.plot(bincenters, gauss(bincenters, *coeff))
+    pyplot.draw()
+    pyplot.show()
+
+def sky_of_image(task):
+    """ Estimate the sky of one image and write it in its header. task is a
+        tuple (image, args), as Pool.map passes a single argument. Returns 
+        (image, sky, sky_std). """
+    image, args = task
     # Separate path and file
-    imdir, imname = os.path.split(args.input[0])
+    imdir, imname = os.path.split(image)
 
     # Read images
-    im = fits.open(args.input[0], mode='update')
-    hdr = im[0].header
-    data = fits.getdata(args.input[0]).astype(numpy.float64)
-    
-    # If mask exist read it, otherwise build it with all values unmasked
-    try:
-        maskname = os.path.join(imdir, hdr[args.mask_key])
-        mask = fits.getdata(maskname)
-    except KeyError:
-        mask = numpy.ma.make_mask_none(data.shape)
-
-    # Make a copy of the array, but only with the unmasked pixels
-    data2 = data.copy
-    data2 = numpy.ma.array(data, mask=mask)
-
-    # Do an histogram and calculate the centre of the bins
-    #n, bins = numpy.histogram(data2,bins=20000, range=(10,5500))
-    n, bins = numpy.histogram(data2, bins=range(1,55000))
-    
-    bincenters = 0.5 * (bins[1:]+bins[:-1])
-
-    # Find max position and value 
-    maxpos = n.argmax()
-    maxvalue = bincenters[maxpos]
-
-    # First guess for a fit
-    p0 = [n[maxpos],maxvalue,5,numpy.mean(n)]
-    coeff, varmatrix = curve_fit(gauss, bincenters,n,p0=p0)
-
-    # Plot the histogram
-    pyplot.plot(bincenters, n, 'o')
-    
-    # Fit the histogram to calculate centre and standard deviation
-    hist_fit = gauss(bincenters, *coeff)
-    
-    # Plot the resulting fit
+    data, hdr = fits.getdata(image, header=True)
+
+    # If mask exist read it, otherwise use all the pixels
+    if args.mask_key != "" and args.mask_key in hdr:
+        mask = fits.getdata(os.path.join(imdir, hdr[args.mask_key]))
+    else:
+        mask = None
+
+    if args.mesh > 0:
+        background, rms = background_map(data, mask, args.mesh, args.filter_size)
+        sky, sky_std = numpy.median(background), numpy.median(rms)
+        bkg_name, rms_name = map_names(image)
+        for name, values, what in [(bkg_name, background, "Background"),
+                                   (rms_name, rms, "RMS")]:
+            map_hdr = hdr.copy()
+            map_hdr.add_history("- " + what + " map of " + imname + ". Mesh of "+\
+                                str(args.mesh) + " pixels, median filter of " +\
+                                str(args.filter_size) + " boxes.")
+            fits.writeto(name, numpy.asarray(values, dtype=numpy.float32),
+                         header=map_hdr, clobber=True)
+    else:
+        sky, sky_std = estimate_sky(data, mask, args.method)
     if args.plot == True:
-        pyplot.plot(bincenters,hist_fit)
-        pyplot.draw()
-        pyplot.show()
+        plot_fit(data, mask)
 
     # Including (or updating) sky values in the header of the image
-    hdr.add_history("- Added sky value and std dev estimated from histogram of" +\
-                    " image. See sky and sky_std keywords.")
-    hdr.update("sky", str(coeff[1]), "Sky value")
-    hdr.update("sky_std", str(coeff[2]), "Standard deviation of sky")    
-    im.flush()
-            
-    return coeff
+    with utils.HeaderTransaction(image) as header:
+        if args.mesh > 0:
+            header.add_history("- Added sky value and std dev, medians of the "+\
+                               "background and RMS maps " + os.path.basename(bkg_name) +\
+                               " and " + os.path.basename(rms_name) + ".")
+            header.update("BKG_MAP", os.path.basename(bkg_name), "Background map")
+            header.update("RMS_MAP", os.path.basename(rms_name), "RMS map")
+        else:
+            header.add_history("- Added sky value and std dev estimated from " +\
+                               "histogram of image. See sky and sky_std keywords.")
+        header.update("sky", str(sky), "Sky value")
+        header.update("sky_std", str(sky_std), "Standard deviation of sky")
+
+    return image, sky, sky_std
+
+def find_sky(args):
+    """ Estimate the sky of all the input images, with a pool of args.jobs
+        processes if more than one (and no plots are requested). Returns a 
+        structured array with the image, sky and sky_std of each image, in the
+        same order as the input. """
+    tasks = [(image, args) for image in args.input]
+    if args.jobs > 1 and not args.plot:
+        pool = multiprocessing.Pool(processes=args.jobs)
+        try:
+            results = pool.map(sky_of_image, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [sky_of_image(task) for task in tasks]
+    return numpy.array(results, dtype=[("image", object), ("sky", numpy.float64),
+                                       ("sky_std", numpy.float64)])
 
 def main(arguments=None):
     if arguments == None:
         arguments = sys.argv[1:]
     args = parser.parse_args(arguments)
-    find_sky(args)
+    return find_sky(args)
 
 
 
@@ -86,19 +345,31 @@ def main(arguments=None):
 parser = argparse.ArgumentParser(description='Find sky for a selection of images.')
 
 # Add necessary arguments to parser
-parser.add_argument("input", metavar='input', action='store', nargs=1, \
+parser.add_argument("input", metavar='input', action='store', nargs="+", \
                    help='list of input images for which to estimate sky.')
 parser.add_argument("--plot", dest='plot', action='store_true', default=False, \
                     help='Plot histogram of image to find sky.')
-parser.add_argument("--mask_key", metavar='mask_key', action='store', 
+parser.add_argument("--mask_key", metavar='mask_key', action='store',
                     dest='mask_key', default="",
                    help='key where the mask image is stored in the header.')
+parser.add_argument("--method", metavar='method', action='store', dest='method',
+                    default="fit", choices=["fit", "histogram", "clip"],
+                    help='Method to estimate the sky: fit (Gaussian fit to the '+\
+                    'peak of the histogram), histogram (mode of the histogram) '+\
+                    'or clip (mode and MAD after sigma clipping). Default: fit')
+parser.add_argument("--jobs", metavar="jobs", dest="jobs", type=int, \
+                    action='store', default=1, help=' Number of processes '+\
+                    'used to estimate the sky of the input images in parallel. '+\
+                    'Ignored with --plot. Default: 1.')
+parser.add_argument("--mesh", metavar="mesh", dest="mesh", type=int, \
+                    action='store', default=0, help=' Size (pixels) of the '+\
+                    'boxes of a mesh to map the background and its RMS, which '+\
+                    'are written as images with suffixes -bkg and -rms. If 0, '+\
+                    'only a single sky value is estimated. Default: 0.')
+parser.add_argument("--filter_size", metavar="filter_size", dest="filter_size", \
+                    type=int, action='store', default=3, help=' Size (boxes) '+\
+                    'of the median filter of the mesh. Default: 3.')
 
 
 if __name__ == "__main__" :
         main()
-
-
-
-
-
@@ -7,6 +7,7 @@
 import astropy.io.fits as fits
 import sys
 import repipy.utilities as utils
+import repipy.header_index as header_index
 import numpy as np
 import os
 
@@ -49,7 +50,7 @@ class Header(object):
 
     def __init__(self, image):
         self.im_name = image
-        self.hdr = fits.getheader(self.im_name)
+        self.hdr = header_index.get_header(self.im_name)
 
 
     @property
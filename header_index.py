@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Persistent index of the headers of the FITS images of a directory, kept in
+    an SQLite database (.repipy_headers.sqlite) inside that directory. The
+    header of an image is read from the file only the first time it is needed
+    or when the file changes (a different modification or change time, size or
+    inode), so the same headers are not parsed again and again by every step
+    of a pipeline. Headers updated in place within the resolution of the times
+    of the filesystem keep all of them, so whoever updates them must forget
+    them (utils.HeaderTransaction does).
+    If the index can not be used (e.g. the directory is not writable) the
+    headers are read from the files.
+
+    E.g.: header_index.refresh("/data/20130606", images)  # one scan of the night
+          filters = [header_index.get_values(im, "FILTER")[0] for im in images]
+"""
+
+import os
+import json
+import sqlite3
+import collections
+import astropy.io.fits as fits
+
+index_name = ".repipy_headers.sqlite"
+
+# Keywords that can appear many times, they are only kept in the full header
+commentary_keywords = ["HISTORY", "COMMENT", ""]
+
+# Connections to the indices, one per process (see --jobs) and directory
+_connections = {}
+
+# Headers parsed recently, {(path, mtime, size, ctime, inode): header}, least
+# recently used first. A file that changes gets a new key (see forget).
+_headers = collections.OrderedDict()
+max_cached_headers = 512
+
+def read_header(path):
+    """ Parse the primary header of a FITS file reading only its blocks of 
+        2880 bytes, up to the one with the END card. The data are never read."""
+    blocks = []
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(2880)
+            if len(block) < 2880:
+                raise IOError("No END card in the header of " + path)
+            blocks.append(block)
+            if any(block[card:card+8] == "END     " for card in range(0, 2880, 80)):
+                break
+    return fits.Header.fromstring("".join(blocks))
+
+def _cached_header(image):
+    """ Header of the image, parsed only if it is not among the recently used
+        ones (or the file changed). It is shared, so it must not be modified."""
+    key = _stat(image)
+    if key in _headers:
+        header = _headers.pop(key)
+    else:
+        header = _indexed_header(*key)
+    _headers[key] = header
+    while len(_headers) > max_cached_headers:
+        _headers.popitem(last=False)
+    return header
+
+def _indexed_header(*key):
+    """ Header of the image from the index, which is updated if needed. key is
+        the path, modification time, size, change time and inode of the image
+        (see _stat). """
+    path = key[0]
+    try:
+        connection = connect(os.path.dirname(path))
+        row = connection.execute("SELECT mtime, size, ctime, inode, header "+\
+                                 "FROM headers WHERE path = ?", (path,)).fetchone()
+        if row is not None and tuple(row[:4]) == key[1:]:
+            return fits.Header.fromstring(str(row[4]))
+        header = read_header(path)
+        with connection:
+            _store(connection, key, header)
+        return header
+    except sqlite3.Error:
+        return read_header(path)
+
+def connect(directory):
+    """ Connection to the index of the directory, created if needed """
+    key = (os.getpid(), os.path.abspath(directory))
+    if key not in _connections:
+        connection = sqlite3.connect(os.path.join(key[1], index_name),
+                                     timeout=60)
+        with connection:
+            columns = [row[1] for row in 
+                       connection.execute("PRAGMA table_info(headers)")]
+            if columns and "inode" not in columns:  # index of older versions
+                connection.execute("DROP TABLE headers")
+                connection.execute("DROP TABLE IF EXISTS keywords")
+            connection.execute("CREATE TABLE IF NOT EXISTS headers (path TEXT "+\
+                               "PRIMARY KEY, mtime REAL, size INTEGER, "+\
+                               "ctime REAL, inode INTEGER, header TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS keywords (path TEXT, "+\
+                               "keyword TEXT, value TEXT, PRIMARY KEY (path, keyword))")
+        _connections[key] = connection
+    return _connections[key]
+
+def _stat(image):
+    """ Absolute path, modification time, size, change time and inode of the
+        image, what tells whether it changed """
+    if not os.path.isfile(image):
+        raise IOError("[Errno 2] No such file or directory: '" + image + "'")
+    path = os.path.abspath(image)
+    stat = os.stat(path)
+    return path, stat.st_mtime, stat.st_size, stat.st_ctime, stat.st_ino
+
+def _store(connection, key, header):
+    """ Save (or replace) the header of an image, with its key (see _stat),
+        in the index """
+    path = key[0]
+    connection.execute("DELETE FROM keywords WHERE path = ?", (path,))
+    connection.execute("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?)",
+                       tuple(key) + (header.tostring(),))
+    values = {}
+    for keyword, value in header.items():
+        if keyword not in commentary_keywords and keyword not in values:
+            try:
+                values[keyword] = json.dumps(value)
+            except TypeError:  # e.g. undefined values
+                values[keyword] = json.dumps(None)
+    connection.executemany("INSERT INTO keywords VALUES (?, ?, ?)",
+                           [(path, key, val) for key, val in values.items()])
+
+def _decode(value):
+    """ json gives unicode strings, astropy gives str (headers are ASCII) """
+    if isinstance(value, unicode):
+        return str(value)
+    return value
+
+def _update(image):
+    """ Make sure the index has the current header of the image. Returns the
+        connection to the index and the path of the image. """
+    key = _stat(image)
+    path = key[0]
+    connection = connect(os.path.dirname(path))
+    row = connection.execute("SELECT mtime, size, ctime, inode FROM headers "+\
+                             "WHERE path = ?", (path,)).fetchone()
+    if row is None or tuple(row) != key[1:]:
+        with connection:
+            _store(connection, key, read_header(path))
+    return connection, path
+
+def refresh(directory, images):
+    """ Update the index of a directory with the images (of that directory),
+        in a single transaction, and forget the images that no longer exist
+        or whose header can not be read. Returns the number of headers read 
+        from the files. If the index can not be used nothing is done, the 
+        headers will be read from the files when needed. """
+    n_read = 0
+    try:
+        connection = connect(directory)
+        known = dict((row[0], tuple(row[1:])) for row in
+                     connection.execute("SELECT path, mtime, size, ctime, "+\
+                                        "inode FROM headers"))
+        with connection:
+            for image in images:
+                key = _stat(image)
+                if known.pop(key[0], None) == key[1:]:
+                    continue
+                try:
+                    _store(connection, key, read_header(key[0]))
+                    n_read += 1
+                except (IOError, ValueError):  # e.g. not a FITS file
+                    known[key[0]] = None
+            for path in known:  # removed, moved or unreadable files
+                if known[path] is None or not os.path.isfile(path):
+                    connection.execute("DELETE FROM headers WHERE path = ?", 
+                                       (path,))
+                    connection.execute("DELETE FROM keywords WHERE path = ?", 
+                                       (path,))
+    except sqlite3.Error:
+        pass
+    return n_read
+
+def forget(image):
+    """ Forget the header of the image, in memory and in the index, e.g.
+        after updating it in place. It is read again the next time. """
+    path = os.path.abspath(image)
+    for key in [key for key in _headers if key[0] == path]:
+        del _headers[key]
+    try:
+        with connect(os.path.dirname(path)) as connection:
+            connection.execute("DELETE FROM headers WHERE path = ?", (path,))
+            connection.execute("DELETE FROM keywords WHERE path = ?", (path,))
+    except sqlite3.Error:
+        pass
+
+def get_header(image):
+    """ Header of the (primary HDU of the) image. It is a copy, that can be 
+        modified (e.g. to write a new image with it). """
+    return _cached_header(image).copy()
+
+def get_values(image, *keywords):
+    """ Values of the keywords in the header of the image, as a list. As with
+        astropy, a KeyError is raised if any of them does not exist. Unless 
+        the header was used recently, they come from the table of keywords of
+        the index, so the header does not need to be parsed. """
+    if _stat(image) not in _headers:
+        try:
+            connection, path = _update(image)
+            rows = connection.execute("SELECT keyword, value FROM keywords "+\
+                                      "WHERE path = ? AND keyword IN (" +
+                                      ", ".join("?" * len(keywords)) + ")",
+                                      [path] + [key.upper() for key in keywords])
+            values = dict((key, _decode(json.loads(value))) for key, value in rows)
+            if all(key.upper() in values for key in keywords):
+                return [values[key.upper()] for key in keywords]
+        except sqlite3.Error:
+            pass
+    # Keywords not in the table (e.g. HIERARCH) are looked for in the header
+    header = _cached_header(image)
+    return [header[key] for key in keywords]
+
+def get_shape(image):
+    """ Shape of the data of the image, as numpy (and astropy) give it """
+    naxis = get_values(image, "NAXIS")[0]
+    return tuple(get_values(image, *["NAXIS" + str(axis) 
+                                     for axis in range(naxis, 0, -1)]))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Build a master calibration image (bias, flat...) incrementally, while the
+    frames are still being taken at the telescope. Every time a frame is added
+    its (scaled) values are accumulated into a state saved on disk: the sum and
+    the number of valid values of every pixel, for the mean, and a reservoir of
+    a bounded number of values per pixel, for the median. Adding a frame only
+    costs reading that frame, and the master can be written at any moment from
+    the state. While the number of frames is not larger than the size of the
+    reservoir the median is exactly the one of combine.py. Beyond that, the
+    reservoir keeps a random sample of the values of each pixel (reservoir
+    sampling) and the median is an estimate from them.
+
+    E.g.: python incremental_combine.py skyflat_R.state skyflat_005.fits
+                 --scale median --output masterskyflat_R.fits --norm """
+
+import os
+import sys
+import json
+import argparse
+import numpy
+import numpy.lib.format
+import astropy.io.fits as fits
+import repipy.utilities as utils
+import repipy.combine as combine
+
+################################################################################
+def state_files(state_dir):
+    """ Names of the files that keep the state of the combination """
+    names = ["state.json", "sum.npy", "count.npy", "reservoir.npy"]
+    return [os.path.join(state_dir, name) for name in names]
+
+def create_state(state_dir, shape, reservoir_size, dtype="float64"):
+    """ Create, in state_dir, an empty state for images of the given shape. 
+        The sum is always kept in float64, the reservoir in dtype. """
+    utils.if_dir_not_exists_create(state_dir)
+    meta_file, sum_file, count_file, reservoir_file = state_files(state_dir)
+    lx, ly = shape
+    for name, array_dtype, state_shape in [(sum_file, numpy.float64, (lx, ly)),
+                                           (count_file, numpy.int32, (lx, ly)),
+                                           (reservoir_file, dtype,
+                                            (reservoir_size, lx, ly))]:
+        array = numpy.lib.format.open_memmap(name, mode="w+", dtype=array_dtype,
+                                             shape=state_shape)
+        if name == reservoir_file:
+            array[:] = numpy.nan
+        del array  # flush to disk
+    meta = {"shape":[lx, ly], "reservoir":reservoir_size, "frames":[]}
+    write_meta(state_dir, meta)
+    return meta
+
+def write_meta(state_dir, meta):
+    """ Save the description of the state (shape, frames added...). It is
+        written to a temporary file first, so it is never left half written."""
+    meta_file = state_files(state_dir)[0]
+    with open(meta_file + ".tmp", "w") as f:
+        json.dump(meta, f, indent=1)
+    os.rename(meta_file + ".tmp", meta_file)
+
+def read_meta(state_dir):
+    """ Read the description of the state """
+    with open(state_files(state_dir)[0]) as f:
+        return json.load(f)
+
+def open_state(state_dir, mode="r+"):
+    """ Memory map the sum, count and reservoir of the state """
+    return [numpy.lib.format.open_memmap(name, mode=mode)
+            for name in state_files(state_dir)[1:]]
+
+################################################################################
+def add_frame(state_dir, meta, image, args):
+    """ Add an image to the state. Its valid (non masked) pixels, divided by
+        the scale of the image, are added to the sum and the count of the
+        pixel and, if there is room in the reservoir of the pixel, stored
+        there. If the reservoir is full, the value replaces a random one of
+        the reservoir with a probability reservoir/count, so that the
+        reservoir is a random sample of all the values of the pixel. """
+    summed, count, reservoir = open_state(state_dir)
+    im = utils.read_image_with_mask(image, mask_keyword=args.mask_key)
+    if list(im.shape) != meta["shape"]:
+        sys.exit("Dimensions of image " + image + " " + str(im.shape) +
+                 " differ from the ones of the combination " + str(meta["shape"]))
+    centre = combine.central_region(*im.shape)
+    scale = combine.scale_of(im[centre[0]:centre[2], centre[1]:centre[3]],
+                             args.scale, image)
+    valid = ~numpy.ma.getmaskarray(im)
+    values = im.data[valid] / scale
+
+    # Choose the slot of the reservoir for each value. Random numbers depend
+    # on the number of frames already added, so the result is reproducible.
+    seen = count[valid]
+    random = numpy.random.RandomState(len(meta["frames"]))
+    slots = numpy.where(seen < meta["reservoir"], seen,
+                        (random.random_sample(len(seen)) * (seen + 1)).astype(int))
+    keep = slots < meta["reservoir"]
+    indicesx, indicesy = numpy.where(valid)
+    reservoir[slots[keep], indicesx[keep], indicesy[keep]] = values[keep]
+    summed[valid] += values
+    count[valid] = seen + 1
+    del summed, count, reservoir  # flush to disk before updating the meta
+    meta["frames"].append({"image":os.path.abspath(image), "scale":float(scale)})
+    write_meta(state_dir, meta)
+
+def build_master(state_dir, meta, args):
+    """ Write the master image, and its mask, from the current state. Pixels
+        with less than nmin valid values are masked and, if the user gave a
+        fill_val, they take that value. Otherwise they keep the average of
+        their valid values if any (there are no others in the state). """
+    summed, count, reservoir = open_state(state_dir, mode="r")
+    if args.average == "mean":
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            image = numpy.ma.array(summed / count, mask=(count == 0))
+    elif args.average == "median":  # in pieces of ~128MB of the reservoir
+        lx, ly = meta["shape"]
+        map_cube = numpy.minimum(count, meta["reservoir"])
+        image = numpy.ma.zeros((lx, ly))
+        image.mask = numpy.zeros((lx, ly), dtype=bool)
+        step = max(1, 2**27 / (reservoir.itemsize * meta["reservoir"] * ly))
+        for xmin in range(0, lx, step):
+            xmax = min(xmin + step, lx)
+            piece = numpy.array(reservoir[:, xmin:xmax])
+            image[xmin:xmax] = combine.nan_median(piece, map_cube[xmin:xmax])
+    image.mask[count < args.nmin] = True
+    image.data[count == 0] = 0.
+    if args.fill_val != '':
+        image.data[image.mask] = float(args.fill_val)
+
+    # Normalize, as combine.py does, with the central third of the result
+    if args.norm:
+        lx, ly = image.shape
+        centre = combine.central_region(lx, ly)
+        norm_value = combine.scale_of(image[centre[0]:centre[2], centre[1]:centre[3]],
+                                      args.scale, args.output)
+        image.data[:] = image.data / norm_value
+        if args.fill_val != '':
+            image.data[image.mask] = float(args.fill_val)
+
+    # Write image and mask
+    if args.out_mask != "":
+        name_mask = args.out_mask
+    else:
+        name_mask = args.output + ".msk"
+    utils.if_exists_remove(args.output, name_mask)
+    hdr = fits.Header()
+    hdr.add_history(" - Image built incrementally from the combination of " +\
+                    "the images: " + ", ".join(os.path.split(frame["image"])[1]
+                                               for frame in meta["frames"]) +\
+                    " combine = " + args.average + ", scale = " + args.scale)
+    if args.average == "median" and len(meta["frames"]) > meta["reservoir"]:
+        hdr.add_history(" - Median estimated from a random sample of " +\
+                        str(meta["reservoir"]) + " values per pixel")
+    if args.norm:
+        hdr.add_history("- NORMALIZED USING MEDIAN VALUE: " + str(norm_value))
+    if args.mask_key != "":
+        hdr[args.mask_key] = (name_mask, "Mask for this image")
+    fits.writeto(args.output, image.data.astype(args.dtype), header=hdr)
+    hdr_mask = fits.Header()
+    hdr_mask.add_history(" - Mask of image: " + args.output)
+    fits.writeto(name_mask, image.mask.astype(numpy.int), header=hdr_mask)
+    return args.output
+
+def incremental_combine(args):
+    """ Add the input images to the state (creating it if it does not exist)
+        and, if an output is given, write the master image. """
+    if os.path.isfile(state_files(args.state)[0]):
+        meta = read_meta(args.state)
+    elif args.input:
+        shape = utils.get_from_header(args.input[0], "NAXIS2", "NAXIS1")
+        meta = create_state(args.state, list(shape), args.reservoir,
+                            dtype=args.dtype)
+    else:
+        sys.exit("State " + args.state + " does not exist and no images were given")
+
+    added = [frame["image"] for frame in meta["frames"]]
+    for image in args.input:
+        if os.path.abspath(image) in added:
+            print "Image " + image + " was already added to " + args.state
+            continue
+        add_frame(args.state, meta, image, args)
+
+    if args.output:
+        return build_master(args.state, meta, args)
+
+############################################################################
+# Create parser
+parser = argparse.ArgumentParser(description='Combine images incrementally')
+parser.add_argument("state", metavar='state', action='store', help='Directory '+\
+                    'where the state of the combination is kept. It is created '+\
+                    'if it does not exist.')
+parser.add_argument("input", metavar='input', action='store', nargs='*', \
+                    help='New images to add to the combination.', type=str)
+parser.add_argument("--output", metavar="output", dest='output', \
+                   action='store', default="", help='Name for output file. If '+\
+                   'not given, the images are only added to the state.')
+parser.add_argument("--average", metavar='average', type=str, default='median', \
+                   choices=["median", "mean"], help='type of average (median, '+\
+                   'mean) to combine the images. Default: median')
+parser.add_argument("--scale", metavar='scale', type=str, default='none', \
+                   help='scaling function (median, mean, none) to apply ' +\
+                   'to the images before adding them. Default: none' )
+parser.add_argument("--reservoir", metavar="reservoir", dest="reservoir", type=int,\
+                    action='store', default=64, help="Number of values kept "+\
+                    "per pixel to calculate the median. Only used when the "+\
+                    "state is created. Default: 64")
+parser.add_argument("--dtype", metavar="dtype", dest="dtype", action='store', \
+                    default="float64", choices=["float64", "float32"], \
+                    help=' Type of the values of the output image and of the '+\
+                    'reservoir (only used when the state is created). The sums '+\
+                    'are always kept in float64. Default: float64')
+parser.add_argument("--norm", action="store_true", dest="norm", default=False, \
+                    help="Normalize resulting image? Default: No")
+parser.add_argument("--nmin", metavar="nmin", type=int, dest="nmin", action='store', \
+                    default=1, help="Minimum number of images with valid "+\
+                    "pixels. If the valid pixels are less than nmin the pixel "+\
+                    "is masked. Default: 1.")
+parser.add_argument("--mask_key", metavar="mask_key", dest='mask_key', \
+                    action='store', default="MASK", help=' Keyword in the header ' +\
+                    'of the image that contains the name of the mask. The mask '+\
+                    'will contain ones (1) in those pixels to be MASKED OUT.')
+parser.add_argument("--output_mask", metavar="output_mask", dest='out_mask', \
+                    action='store', default="", help=' Name of the output mask. '
+                    'If none is provided, the program will add .msk '+\
+                    'to the output name.')
+parser.add_argument("--fill_val", metavar="fill_val", dest="fill_val", \
+                    action='store', default='', help=' If present, this '+\
+                    'value substitutes the result in those pixels that are masked. ')
+
+def main(arguments = None):
+  # Pass arguments to variable args
+  if arguments == None:
+      arguments = sys.argv[1:]
+  args = parser.parse_args(arguments)
+  newfile = incremental_combine(args)
+  return newfile
+
+if __name__ == "__main__":
+    main()
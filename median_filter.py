@@ -10,6 +10,7 @@ import numpy
 import sys
 import argparse
 import repipy.utilities as utils
+import repipy.header_index as header_index
 import astropy.io.fits as fits
 import skimage.filter
           
@@ -18,8 +19,9 @@ def filter_image(args):
     output_list = []
     for image in args.input:
         # Read image, mask and header
-        im = utils.read_image_with_mask(image, mask_keyword=args.mask_key)
-        hdr = fits.getheader(image)
+        im = utils.read_image_with_mask(image, mask_keyword=args.mask_key, 
+                                        dtype=args.dtype)
+        hdr = header_index.get_header(image)
         
         # skimage uses masks where 1 means valid and 0 invalid
         mask = (im.mask + 1) % 2
@@ -33,7 +35,7 @@ def filter_image(args):
         
         # Add history line to the header and write to file
         hdr.add_history("- Image median filtered. Radius = " + str(args.radius))
-        fits.writeto(output, filt_im, header=hdr)
+        fits.writeto(output, numpy.asarray(filt_im, dtype=args.dtype), header=hdr)
         output_list.append(output)
     return output_list
     
@@ -55,6 +57,10 @@ parser.add_argument("--output", metavar='output', dest='output', action='store',
                    default='', help='output image in which to save the result.'+\
                     ' If not provided the suffix -mf will be added to '+\
                     'the input.')          
+parser.add_argument("--dtype", metavar="dtype", dest="dtype", action='store', \
+                    default="float64", choices=["float64", "float32"], \
+                    help=' Type of the values of the image, as read and as '+\
+                    'written. Default: float64')
 
 ############################################################################                   
 
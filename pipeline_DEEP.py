@@ -11,6 +11,7 @@ They do not have comprehensible names, but are in sequence and contain raw data.
 
 import os, shutil, re, sys, glob
 import subprocess
+import multiprocessing
 import pyraf.iraf as iraf
 # Advice from Victor Terron in his "lemon setup.py" about how to run mkiraf 
 # automatically: 
@@ -20,6 +21,7 @@ if os.path.isfile("login.cl") == False:
 import numpy as np
 import datetime
 import repipy.utilities as utilities
+import repipy.catalogues as catalogues
 import repipy.combine as combine_images
 import repipy.arith as arith
 #import repipy.tidy_up2 as tidy_up
@@ -173,8 +175,11 @@ for time, image in master_blanks.items():
                                              "--mask_key", "mask"]+
                                              image + ["/"] + 
                                              master_skyflats.values()[closest])
-    smoothed = median_filter.main(arguments= corrected + [ "--mask_key", "mask",
-        "--radius", "150"])
+    # Large scale structure from a background map (boxes of 100 pixels, 
+    # median filtered over 3x3 boxes), much faster than a median filter of 
+    # radius 150
+    find_sky.main(arguments=["--mask_key", "mask", "--mesh", "100"] + corrected)
+    smoothed = [find_sky.map_names(im)[0] for im in corrected]
     master_blanks[time] = smoothed
 
 # Now we will correct each image with the closest sky flat field (for small
@@ -250,9 +255,13 @@ for index, image in enumerate(list_images["filename"]):
         utilities.header_update_keyword(newname, "SEX CATALOG", short_name)
 
 print "Estimate sky for images of CIG(s), standard(s) and cluster(s) "
-for index, image in enumerate(list_images["filename"]):
-    if list_images["type"][index] in ["cig","standards","clusters"]:
-        find_sky.main(arguments=[list_images["filename"][index]])
+whr = np.where((list_images["type"] == "cig") | (list_images["type"] == "standards") |
+               (list_images["type"] == "clusters"))
+sky_std = {}
+if len(whr[0]) > 0:
+    sky_table = find_sky.main(arguments=["--jobs", str(multiprocessing.cpu_count())] +
+                                        list(list_images["filename"][whr]))
+    sky_std = dict(zip(sky_table["image"], sky_table["sky_std"]))
 
 print "Detecting objects for images of CIG(s), standard(s) and cluster(s)"
 # This part follows the example in the webpage:
@@ -271,7 +280,7 @@ for index, image in enumerate(list_images["filename"]):
         FWHM = min(max_FWHM,float(hdr["LEMON FWHM"]))
         iraf.daofind.setParam('fwhmpsf', FWHM)       
         iraf.daofind.setParam('output', outfile)
-        iraf.daofind.setParam('sigma', float(hdr["SKY_STD"]))
+        iraf.daofind.setParam('sigma', sky_std[image])
         iraf.daofind.setParam('gain', gaink)
         iraf.daofind.setParam('readnoise', float(hdr[read_noisek]))
         iraf.daofind.setParam('roundlo', -0.3)  # Minimal roundness  (0 is round)
@@ -302,7 +311,6 @@ for current_object in objects_need_aligning:
     # Open files to store data that imalign will need later on
     obj_list = open(current_object + ".lis", "w")
     shifts_list = open(current_object + ".shifts", "w")    
-    coords_list = open(current_object + ".coords","w")
     output_list = open(current_object + ".out", "w")
 
     # All images of this object. Read fiirst as reference
@@ -310,25 +318,15 @@ for current_object in objects_need_aligning:
     ref_im = list_images["filename"][whr[0]]
     ref_catalog = utilities.replace_extension(ref_im, ".cat")
     
-    # Txdump writes to a temporary file, then we read it
-    iraf.ptools(_doprint=0)
-    if os.path.isfile("temp.txt"):
-        os.remove("temp.txt")
-    iraf.txdump(ref_catalog, "xcenter, ycenter, mag", "yes", Stdout="temp.txt")
-    x_ref=y_ref=mag_ref=np.array([],dtype=np.float16)
-    with open("temp.txt") as f:
-        for line in f:
-            x_ref = np.append(x_ref,float(line.split()[0]))
-            y_ref = np.append(y_ref,float(line.split()[1]))
-            mag_ref = np.append(mag_ref, float(line.split()[2]))  
+    # Read the fields txdump would give from the catalogue
+    stars = catalogues.read_iraf(ref_catalog)
+    x_ref, y_ref, mag_ref = stars["XCENTER"], stars["YCENTER"], stars["MAG"]
     brightest_stars = np.argsort(mag_ref)[:nstars] 
     x_ref = x_ref[brightest_stars] 
     y_ref = y_ref[brightest_stars]
     
     #Write to a file, which imalign will need later
-    for ii,jj in zip(x_ref,y_ref):
-        coords_list.write( str(ii) + " " + str(jj) + "\n")
-    coords_list.close()
+    catalogues.write_columns(current_object + ".coords", [x_ref, y_ref])
             
     # Finally, one by one, calculate the shifts  
     for index in whr:  # for all images of the current_object
@@ -341,19 +339,11 @@ for current_object in objects_need_aligning:
         
         # Catalog for the new image                
         new_catalog = utilities.replace_extension(new_im, ".cat")
-        if os.path.exists("temp.txt"):
-            os.remove("temp.txt")
-        iraf.txdump(new_catalog, "xcenter, ycenter, mag", "yes", Stdout="temp.txt")
-        x_new=y_new=mag_new=np.array([],dtype=np.float16)
-        with open("temp.txt") as f:
-            for line in f:
-                x_new = np.append(x_new,float(line.split()[0]))
-                y_new = np.append(y_new,float(line.split()[1]))
-                mag_new = np.append(mag_new, float(line.split()[2]))
+        stars = catalogues.read_iraf(new_catalog)
+        x_new, y_new, mag_new = stars["XCENTER"], stars["YCENTER"], stars["MAG"]
         brightest_stars = np.argsort(mag_new)[:nstars]
         x_new = x_new[brightest_stars]
         y_new = y_new[brightest_stars]
-        os.remove("temp.txt")
         result = cross_match.main(xref=x_ref, yref=y_ref, xobj=x_new, 
                                   yobj=y_new, error=0.01, scale=1, angle=0, 
                                   flip=False, test=False)
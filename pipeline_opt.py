@@ -8,6 +8,7 @@ Created on Thu Oct  3 09:48:35 2013
 
 import os, shutil, re, sys, glob
 import subprocess
+import multiprocessing
 import pyraf.iraf as iraf
 import scipy.ndimage.filters as filters
 import dateutil.parser
@@ -19,6 +20,7 @@ if os.path.isfile("login.cl") == False:
 import numpy as np
 import datetime
 import repipy.utilities as utilities
+import repipy.catalogues as catalogues
 import repipy.combine as combine_images
 import repipy.arith as arith
 import repipy.create_masks as create_masks
@@ -60,8 +62,9 @@ print "Include homogeneous filter names into the filter keyword"
 for im in list_images["filename"]:
     imfilt = utilities.get_from_header(im, filterk)
     imfilt2 = utilities.homogeneous_filter_name(imfilt)
-    utilities.header_update_keyword(im, filterk+"_OLD", imfilt, "Original filter name")
-    utilities.header_update_keyword(im, filterk,        imfilt2, "Revised filter name")
+    with utilities.HeaderTransaction(im) as hdr:
+        hdr.update(filterk+"_OLD", imfilt, "Original filter name")
+        hdr.update(filterk,        imfilt2, "Revised filter name")
     
 
 print "Ignore images as selected by user, if any."
@@ -138,7 +141,7 @@ if circular_FoV:
     for index in flat_indices:
         print index
         print list_images["filename"][index]
-        mask_name = fits.getval(list_images["filename"][index], "mask")
+        mask_name = utilities.get_from_header(list_images["filename"][index], "mask")
         mask = fits.getdata(mask_name)
         if np.any(mask == 2):
             break
@@ -149,18 +152,21 @@ if circular_FoV:
         image.close()
              
 print "Estimate sky for images of CIG(s), standard(s) and cluster(s) "
-for index, image in enumerate(list_images["filename"]):
-    if list_images["type"][index] in ["cig","standards","clusters"]:
-        find_sky.main(arguments=[list_images["filename"][index]])  
+whr = np.where((list_images["type"] == "cig") | (list_images["type"] == "standards") |
+               (list_images["type"] == "clusters"))
+if len(whr[0]) > 0:
+    sky_table = find_sky.main(arguments=["--jobs", str(multiprocessing.cpu_count())] +
+                                        list(list_images["filename"][whr]))
         
 print "Removing cosmic rays from images"
-for index, im in enumerate(list_images["filename"]):
-    if list_images["type"][index] in ["cig", "standards", "clusters"]:        
-            newname = remove_cosmics.main(arguments=["--suffix", " -c", 
-                                          "--gain", str(fits.getval(im, gaink)), 
-                                          "--readnoise", str(fits.getval(im, read_noisek)),
-                                          "--sigclip", "5", "--maxiter", "3", im])
-            list_images["filename"][index] = newname
+if len(whr[0]) > 0:
+    newnames = remove_cosmics.main(arguments=["--suffix", " -c", 
+                                   "--gain", gaink, "--readnoise", read_noisek,
+                                   "--sigclip", "5", "--maxiter", "3", 
+                                   "--tile", "512", "--jobs", 
+                                   str(multiprocessing.cpu_count())] + 
+                                   list(list_images["filename"][whr]))
+    list_images["filename"][whr] = newnames
 
 #print "Calculate smoother version of images"
 #for index, im in enumerate(list_images["filename"]):
@@ -211,10 +217,8 @@ for index, im in enumerate(list_images["filename"]):
         corr_file = utilities.replace_extension(im, "corr")
         table = fits.open(corr_file)[1]
         cat_radec = utilities.replace_extension(im, "radec")
-        f = open(cat_radec, "w")
-        for line in table.data:
-            f.write(str(line[2]) + " " + str(line[3]) + "\n")            
-        f.close()
+        catalogues.write_columns(cat_radec, [table.data.field(2),
+                                              table.data.field(3)])
         
 #        # Move all filtered images related to im to their own directory
 #        directory, filename = os.path.split(im) 
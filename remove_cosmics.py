@@ -4,99 +4,207 @@
 import argparse
 import sys
 import os
+import multiprocessing
 import repipy.utilities as utils
+import repipy.header_index as header_index
 import cosmics_04.cosmics as cosmics
-import astropy.io.fits as fits
-""" This routine uses cosmic.py (Malte Tewes, 2010), the python version of LACOS 
-    (Van Dokkum, PASP 2001) to remove cosmic rays from an astronomical image. 
-     It requires for the cosmic.py module to be in the path, obviously. Some of 
-     the options of cosmic rays (e.g. sigfrac, objlim) are not input by the 
-     user in this wrapper. """
+""" This routine uses cosmic.py (Malte Tewes, 2010), the python version of LACOS
+    (Van Dokkum, PASP 2001) to remove cosmic rays from an astronomical image.
+     It requires for the cosmic.py module to be in the path, obviously. Some of
+     the options of cosmic rays (e.g. sigfrac, objlim) are not input by the
+     user in this wrapper.
 
+     With --tile the images are divided in tiles of that many pixels, which
+     are processed in parallel by --jobs processes. Each tile is extended by
+     a halo as wide as the reach of an L.A.Cosmic iteration, and the tiles
+     are stitched back after every iteration, so the result is the same as
+     that of the whole image in one piece. """
+
+# Reach (pixels) of one L.A.Cosmic iteration: the Laplacian of the subsampled
+# image (1), the 5x5 medians of the noise and of the significance (2 + 2),
+# which also cover the 3x3 and 7x7 medians of the fine structure (1 + 3), the
+# two growths of the detections (1 + 1) and the 5x5 window of clean() (2)
+halo = 8
+
+def value_or_keyword(image, value):
+    """ The value, if it is a number, or otherwise the value of that keyword
+        in the header of the image """
+    try:
+        return float(value)
+    except ValueError:
+        return float(header_index.get_values(image, value)[0])
+
+def tiles(shape, tile):
+    """ Pieces of an image of that shape, in tiles of tile x tile pixels (the
+        whole image if tile is 0). Returns, for each tile, the slices of the
+        tile with its halo in the image and of the tile within those. """
+    pieces = []
+    limits = [[(start, min(start + tile, size)) for start in range(0, size, tile)]
+              if tile > 0 else [(0, size)] for size in shape]
+    for (y0, y1) in limits[0]:
+        for (x0, x1) in limits[1]:
+            hy0, hx0 = max(y0 - halo, 0), max(x0 - halo, 0)
+            outer = (slice(hy0, min(y1 + halo, shape[0])),
+                     slice(hx0, min(x1 + halo, shape[1])))
+            core = (slice(y0 - hy0, y1 - hy0), slice(x0 - hx0, x1 - hx0))
+            pieces.append((outer, core))
+    return pieces
+
+def cosmics_iteration(task):
+    """ One L.A.Cosmic iteration on a tile, detection and cleaning, as done by
+        cosmicsimage.run(). task is a tuple (clean, mask, satstars, background,
+        core, params), as Pool.map passes a single argument, where satstars and
+        the background level come from the whole image. Returns the clean tile
+        and its mask, without the halo, and the number of cosmic pixels found
+        and of new ones. """
+    clean, mask, satstars, background, core, params = task
+    c = cosmics.cosmicsimage(clean, verbose=False, **params)
+    c.mask = mask.copy()
+    c.satstars = satstars
+    c.backgroundlevel = background
+    iterres = c.lacosmiciteration(verbose=False)
+    c.clean(verbose=False)
+    nnew = (c.mask & ~mask)[core].sum()
+    return c.cleanarray[core], c.mask[core], iterres["itermask"][core].sum(), nnew
+
+def lacosmic(array, params, maxiter, tile=0, pool=None):
+    """ Remove the cosmic rays of the array with L.A.Cosmic, in tiles of tile
+        x tile pixels (with the pool, if given). The saturated stars and the
+        background level are found in the whole image, as well as when to
+        stop iterating. Returns the clean array and the mask of cosmic rays."""
+    image = cosmics.cosmicsimage(array, verbose=False, **params)
+    if image.satlevel > 0:
+        image.findsatstars(verbose=False)
+    background = image.guessbackgroundlevel()
+    clean, mask, satstars = image.cleanarray, image.mask, image.satstars
+    pieces = tiles(clean.shape, tile)
+    for ii in range(1, maxiter + 1):
+        tasks = [(clean[outer], mask[outer],
+                  None if satstars is None else satstars[outer], background,
+                  core, params) for outer, core in pieces]
+        if pool is not None:
+            results = pool.map(cosmics_iteration, tasks)
+        else:
+            results = [cosmics_iteration(task) for task in tasks]
+        # New arrays, as the tasks may still be views of the old ones
+        clean, mask = clean.copy(), mask.copy()
+        for (outer, core), (clean_tile, mask_tile, niter, nnew) in zip(pieces, results):
+            tile_slice = tuple(slice(o.start + c.start, o.start + c.stop)
+                               for o, c in zip(outer, core))
+            clean[tile_slice] = clean_tile
+            mask[tile_slice] = mask_tile
+        niter = sum(result[2] for result in results)
+        print "Iteration %i: %i cosmic pixels (%i new)" % \
+              (ii, niter, sum(result[3] for result in results))
+        if niter == 0:
+            break
+    return clean, mask
 
 def remove_cosmics(args):
+    """ Remove the cosmic rays of all the input images. Returns the names of
+        the clean images, in the same order. """
+    pool = None
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(processes=args.jobs)
+    try:
+        newfiles = [clean_image(image, args, pool) for image in args.input]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return newfiles
+
+def clean_image(image, args, pool=None):
+    """ Remove the cosmic rays of one image """
     if args.output != '':
         newfile = args.output
     else:
-        newfile = utils.add_suffix_prefix(args.input[0], prefix = args.prefix, \
+        newfile = utils.add_suffix_prefix(image, prefix = args.prefix, \
                                         suffix = args.suffix )
-    
+    gain = value_or_keyword(image, args.gain)
+    readnoise = value_or_keyword(image, args.readnoise)
+
     # Read the FITS :
-    array, header = cosmics.fromfits(args.input[0])
-    # Build the object :
-    c = cosmics.cosmicsimage(array, gain = float(args.gain), sigfrac = 0.3, \
-                             readnoise = float(args.readnoise), objlim = 5.0, \
-                             sigclip = float(args.sigclip))
-    # Run the full artillery :
-    c.run(maxiter = int(args.maxiter))
-    
+    array, header = cosmics.fromfits(image)
+    # Run the full artillery, tile by tile :
+    params = {"gain":gain, "readnoise":readnoise, "sigclip":float(args.sigclip),
+              "sigfrac":0.3, "objlim":5.0}
+    cleanarray, mask = lacosmic(array, params, int(args.maxiter), args.tile, pool)
+
     # Write the cleaned image into a new FITS file, conserving the header:
-    cosmics.tofits(newfile, c.cleanarray, header)
-    
+    cosmics.tofits(newfile, cleanarray, header)
+
     # If you want the mask, here it is :
     if args.mask == True:
-        mask = utils.add_suffix_prefix(newfile, prefix="cosmic_mask")    
-        cosmics.tofits(mask, c.mask, header)
-                          
+        maskfile = utils.add_suffix_prefix(newfile, prefix="cosmic_mask")
+        cosmics.tofits(maskfile, mask, header)
+
     # And write info to the header:
-    im = fits.open(newfile, mode='update')
-    hdr = im[0].header
-    hdr.add_history("COSMIC RAYS REMOVED:")
-    oldname = os.path.split(args.input[0])[1]
-    newname = os.path.split(newfile)[1]
-    hdr.add_history(oldname + " --> " + newname)
-    hdr.add_history("Parameters used by cosmics.py. Gain=" + args.gain + \
-                    ", sigfrac=0.3, objlim=5.0, sigclip=" + args.sigclip + \
-                    ", readnoise=" + args.readnoise)   
-    im.flush()
-    im.close()                
+    with utils.HeaderTransaction(newfile) as hdr:
+        hdr.add_history("COSMIC RAYS REMOVED:")
+        oldname = os.path.split(image)[1]
+        newname = os.path.split(newfile)[1]
+        hdr.add_history(oldname + " --> " + newname)
+        hdr.add_history("Parameters used by cosmics.py. Gain=" + str(gain) + \
+                        ", sigfrac=0.3, objlim=5.0, sigclip=" + args.sigclip + \
+                        ", readnoise=" + str(readnoise))
     return newfile
-    
-    
-    
+
+
+
 
 # Create parser
 parser = argparse.ArgumentParser(description='Remove cosmic rays in images')
-parser.add_argument("input",metavar='input', action='store', nargs=1,  \
-                    help='Image to be corrected for cosmic ray hits.')
+parser.add_argument("input",metavar='input', action='store', nargs="+",  \
+                    help='Image(s) to be corrected for cosmic ray hits.')
 parser.add_argument("--output", metavar='output', action='store', dest='output', \
-                    default='', help='Name of output file.')                    
+                    default='', help='Name of output file. Only for a single '+\
+                    'input image.')
 parser.add_argument("--prefix", metavar="prefix", dest='prefix', action='store', \
                     default='',help='prefix to be added at the beginning of the '+\
                     'image input list to generate the output.')
 parser.add_argument("--suffix", metavar="suffix", dest='suffix', action='store', \
                     default='',help='suffix to be added at the end of the image' +\
-                    'input list to generate the output.') 
+                    'input list to generate the output.')
 parser.add_argument("--gain", metavar='gain', action='store', dest='gain',\
                     default='2', help="Gain (either value or keyword from the header) "+\
-                    "of the telescope in e-/ADU. Default: 2" )                    
+                    "of the telescope in e-/ADU. Default: 2" )
 parser.add_argument("--readnoise", metavar="readout noise", action='store', \
                     dest='readnoise', default="5", help="Readout noise of the"+\
                     "telescope (value or header keyword) in e-. Default: 5")
 parser.add_argument("--sigclip", metavar="sigmaclip", action='store', dest='sigclip',\
                     default="5.", help=" Sigma clipping factor in order to "+\
                     "distinguish noise from cosmic rays. Higher value are "+\
-                    "recommended for high S/N images.")                  
+                    "recommended for high S/N images.")
 parser.add_argument("--create_mask", action="store_true", dest="mask", \
                     help="Add this keyword if you want to create a mask. The "+\
                     "mask will be called cosmic_mask-... ", default=False)
 parser.add_argument("--maxiter", metavar='maxiter', action='store', dest='maxiter',\
                     default='3', help="Maximum number of iterations searching "+\
-                    "for cosmic rays. See the documentation of cosmics or LACOS" )                    
+                    "for cosmic rays. See the documentation of cosmics or LACOS" )
+parser.add_argument("--tile", metavar='tile', action='store', dest='tile', \
+                    type=int, default=0, help="Size (pixels) of the tiles in "+\
+                    "which the images are divided, to process them in parallel. "+\
+                    "The result does not depend on it. Default: 0 (whole image)")
+parser.add_argument("--jobs", metavar="jobs", dest="jobs", type=int, \
+                    action='store', default=1, help=' Number of processes '+\
+                    'that clean the tiles in parallel. Default: 1.')
 
 
 
 def main(arguments=None):
-    # Pass arguments to variable 
+    # Pass arguments to variable
     if arguments == None:
         arguments = sys.argv[1:]
     args = parser.parse_args(arguments)
-    if args.output == '' and args.prefix == '' and args.suffix == '':  
+    if args.output == '' and args.prefix == '' and args.suffix == '':
         sys.exit("Error! Introduce a prefix, a suffix or an output filename. "+\
-                 "For help: python remove_cosmics.py -h ")    
+                 "For help: python remove_cosmics.py -h ")
+    if args.output != '' and len(args.input) > 1:
+        sys.exit("Error! --output can only be used with a single input image.")
     if args.suffix != "":
       args.suffix = args.suffix.strip()
-    newfile = remove_cosmics(args)
-    return newfile             
+    newfiles = remove_cosmics(args)
+    return newfiles
 if __name__ == "__main__":
     main()
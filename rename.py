@@ -25,7 +25,7 @@ sao110 for standards.
 #     night. Could lead to mistakes? Other options?
 ##############################################################################################################################
 
-import os, glob, shutil
+import os, shutil, fnmatch
 import collections 
 import astropy.io.fits as fits
 import sys
@@ -38,6 +38,7 @@ import re
 import repipy.find_keywords as find_keywords
 import numpy as np
 import repipy.utilities as utils
+import repipy.header_index as header_index
 
 #############################################################################
 def is_a_standar(object_name):
@@ -151,10 +152,16 @@ def distinguish_type(object_name):
 
 ###########################################################################
 def rename(args):
-    # List of fit and fits images in the directory
-    fits_list1 = glob.glob(os.path.join(args.in_dir, args.in_pattern + "*.fits"))
-    fits_list2 = glob.glob(os.path.join(args.in_dir, args.in_pattern + "*.fit"))
-    fits_list = fits_list1+fits_list2
+    # List of fit and fits images in the directory, with a single listing
+    found = utils.find_files(args.in_dir, 
+                             {"fits":fnmatch.translate(args.in_pattern + "*.fits"),
+                              "fit":fnmatch.translate(args.in_pattern + "*.fit")},
+                             match=True, recursive=False)
+    # (like glob, hidden files are left out)
+    found = [(path, key) for path, key, match in found 
+             if not os.path.basename(path).startswith(".")]
+    fits_list = [path for path, key in found if key == "fits"] +\
+                [path for path, key in found if key == "fit"]
 
     # If the needed keywords were passed by the user, build a dictionary with 
     # them, otherwise, read from config file (if present) the names of the 
@@ -166,7 +173,7 @@ def rename(args):
                        "date":args.datek, "exptime":args.exptimek,\
                        "time":args.timek}
     else:
-        hdr = fits.getheader(fits_list[0])
+        hdr = header_index.get_header(fits_list[0])
         keywords = find_keywords.get_keywords(hdr, needed, args) 
 
     # The output of the whole code will be this dictionary, in which the images 
@@ -195,13 +202,15 @@ def rename(args):
     ff.write("CHECK WITH OBSERVING LOG: \n \n")
     ff.write("ORIG_NAME, NEW_NAME   , OBJECT   , FILTER  , DATE  , EXPTIME \n ")    
 
-    # Look for the date and time of all images
+    # Look for the date and time of all images. The headers come from the 
+    # index of the directory, updated with a single scan.
+    header_index.refresh(args.in_dir, fits_list)
     list_datetimes =[]
     for names in fits_list:
-        im = fits.open(names) 
-        hdr = im[0].header  
-        date_current = dateutil.parser.parse(hdr[keywords["date"]]).date()
-        time_current = dateutil.parser.parse(hdr[keywords["time"]]).time()
+        date_value, time_value = header_index.get_values(names, keywords["date"],
+                                                         keywords["time"])
+        date_current = dateutil.parser.parse(date_value).date()
+        time_current = dateutil.parser.parse(time_value).time()
         datetime_current = datetime.datetime.combine(date_current, time_current) 
         # If user didn't provide any time keyword but date_current does not 
         # actually contain the time this time_current will be 00:00:00. Problem?
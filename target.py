@@ -192,7 +192,7 @@ class Target(object):
         """
         type, name = 'Unknown', 'Unknown'
         w = wcs.wcs.WCS(self.header.hdr)
-        ly, lx = fits.getdata(self.header.im_name).shape
+        ly, lx = self.header.hdr["NAXIS2"], self.header.hdr["NAXIS1"]
         # ra_min, dec_min will be the coordinates of pixel (0,0)
         # ra_max, dec_max the coordinates of the upper right corner of the image.
         # But beware, the orientation could be such that ra_min > ra_max if the image is not oriented North
@@ -15,6 +15,13 @@ import astropy.coordinates as coords
 from astropy.time import Time
 import dateutil.parser
 import shutil
+import repipy.header_index as header_index
+import repipy.catalogues as catalogues
+from multiprocessing.pool import ThreadPool
+try:
+    from scandir import walk  # much faster than os.walk before python 3.5
+except ImportError:
+    from os import walk
 
 
 import functools
@@ -32,9 +39,10 @@ def memoize(f):
     return memf
 
 def collect_from_images(image_list, keyword):
-    """ From a list of images collect a single keyword """
+    """ From a list of images collect a single keyword (through the index of
+        the headers, see header_index) """
     try:
-        return [fits.getval(im, keyword) for im in image_list]
+        return [header_index.get_values(im, keyword)[0] for im in image_list]
     except KeyError:
         sys.exit("Keyword %s does not exist in image %s" % (keyword, im))
 
@@ -63,11 +71,13 @@ def update_WCS(image_without_wcs, image_with_wcs):
 
 def get_from_header(image_name, *args):
     """ From the header of an image, get the values corresponding to the 
-        keywords passed in args"""
+        keywords passed in args (through the index of the headers, see 
+        header_index)"""
+    values = header_index.get_values(image_name, *args)
     if len(args) == 1:
-        return fits.getval(image_name, args[0])
+        return values[0]
     else:
-        return (fits.getval(image_name, x) for x in args)
+        return tuple(values)
 
 def precess_to_2000(RA, DEC, time):
     """ From the actual coordinates of an object in the sky for a certain 
@@ -95,7 +105,7 @@ def check_dimensions(image_list):
     dimensions = []
     for image in image_list:
         try:  # try to open
-            dimensions.append(fits.open(image, mode="readonly")[0].shape)
+            dimensions.append(header_index.get_shape(image))
         except IOError:
             try: #check if float
                 float(image)
@@ -112,29 +122,168 @@ def check_dimensions(image_list):
             print image, size        
         return False
 
-def read_image_with_mask(image, mask_keyword=None, limits = 0, header=None):
+def read_image_with_mask(image, mask_keyword=None, limits = 0, header=None, dtype=np.float64):
     """ Read an image and a mask (from a keyword in the image), save it into a numpy.ma array.
     The mask should contain 1 for pixels to be masked out. Limits allows to read only a part of an image, avoiding
     the need to read it all into memory. Limit should be limits = (min_x, min_y, max_x, max_y), use limit=0 to use all
-    image (DEFAULT: all image)."""
-
-    # Set the limits
-    header = fits.getheader(image)
-    if limits == 0:
-        min_x, min_y = (0, 0)
-        max_x, max_y = header["NAXIS2"], header["NAXIS1"]
-    else:
-        min_x, min_y, max_x, max_y = limits
-
-
-    # Open both image and mask (if present)
-    with fits.open(image, memtype=True) as im:
-        data = im[0].data[min_x:max_x, min_y:max_y]
-        if mask_keyword:
-            mask = fits.open(header[mask_keyword], memtype=True)[0].data[min_x:max_x, min_y:max_y]
+    image (DEFAULT: all image). dtype is the type of the values of the array (DEFAULT: float64), float32 is enough
+    for the 16 bits of raw images and halves the memory."""
+    with MaskedImageReader(image, mask_keyword=mask_keyword) as reader:
+        return reader.read(limits, dtype=dtype)
+
+class MaskedImageReader(object):
+    """ Keep an image and its mask (from a keyword in the image, if any) open 
+        as memory maps, so that pieces of them can be read many times without 
+        opening the files and parsing the headers again. If the image has a 
+        MASK extension (see write_image_with_mask) that is the mask, and no 
+        other file is opened. The pieces are numpy.ma arrays, as in 
+        read_image_with_mask. Use close() (or a with statement) to release the
+        files. """
+
+    def __init__(self, image, mask_keyword=None):
+        self.image = image
+        self._hdulists = []
+        hdulist = self._open(image)
+        self.hdu = hdulist[0]
+        self.header = self.hdu.header
+        if "MASK" in [hdu.name for hdu in hdulist[1:]]:
+            self.mask_hdu = hdulist["MASK"]
+        elif mask_keyword:
+            self.mask_hdu = self._open(self.header[mask_keyword])[0]
+        else:
+            self.mask_hdu = None
+
+    def _open(self, filename):
+        """ Open the file without scaling the data, which would force astropy 
+            to read the whole image into memory. See _section for the scaling. """
+        hdulist = fits.open(filename, memmap=True, do_not_scale_image_data=True)
+        self._hdulists.append(hdulist)
+        return hdulist
+
+    def _section(self, hdu, min_x, min_y, max_x, max_y):
+        """ Copy a piece of the data of an HDU, scaling it with BSCALE and 
+            BZERO (if present) the same way astropy does with the full image."""
+        raw = hdu.data[min_x:max_x, min_y:max_y]
+        bscale, bzero = hdu.header.get("BSCALE", 1), hdu.header.get("BZERO", 0)
+        blank = hdu.header.get("BLANK")
+        if bscale == 1 and bzero == 0 and blank is None:
+            return np.array(raw)
+        if hdu.header["BITPIX"] > 16:
+            section = np.array(raw, dtype=np.float64)
+        else:
+            section = np.array(raw, dtype=np.float32)
+        if bscale != 1:
+            section *= bscale
+        if bzero != 0:
+            section += bzero
+        if blank is not None:
+            section[raw == blank] = np.nan
+        return section
+
+    def read(self, limits=0, dtype=np.float64):
+        """ Read the piece of the image and mask given by limits = (min_x, 
+            min_y, max_x, max_y), or all of them if limits=0, as a masked
+            array of type dtype."""
+        if limits == 0:
+            min_x, min_y = (0, 0)
+            max_x, max_y = self.header["NAXIS2"], self.header["NAXIS1"]
+        else:
+            min_x, min_y, max_x, max_y = limits
+        data = self._section(self.hdu, min_x, min_y, max_x, max_y)
+        if self.mask_hdu is not None:
+            mask = self._section(self.mask_hdu, min_x, min_y, max_x, max_y)
         else:
             mask = np.zeros_like(data)
-    return np.ma.array(data, mask=mask, dtype=np.float64)
+        return np.ma.array(data, mask=mask, dtype=dtype)
+
+    def close(self):
+        """ Close the image and the mask """
+        for hdulist in self._hdulists:
+            hdulist.close()
+        self._hdulists = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def write_image_with_mask(filename, data, mask, header=None, mask_header=None,
+                          compress=False):
+    """ Write an image and its mask in a single FITS file: the image in the 
+    primary HDU and the mask (1 for pixels masked out) as an 8 bits extension
+    called MASK, tile compressed if compress is True. read_image_with_mask
+    reads the mask from the extension, so no keyword pointing to it is needed."""
+    hdulist = fits.HDUList([fits.PrimaryHDU(data, header=header), 
+                            mask_extension(mask, mask_header, compress)])
+    hdulist.writeto(filename)
+
+def mask_extension(mask, mask_header=None, compress=False):
+    """ HDU with the mask, as 8 bits, for write_image_with_mask """
+    mask = np.asarray(mask, dtype=np.uint8)
+    mask_hdu = fits.ImageHDU(mask, header=mask_header, name="MASK")
+    if compress:
+        mask_hdu = fits.CompImageHDU(mask, header=mask_hdu.header, name="MASK",
+                                     compression_type="RICE_1")
+    return mask_hdu
+
+class MaskedImageWriter(object):
+    """ Write an image and its mask a block of rows at a time, from the first
+        to the last, so that the whole image is never in memory. The mask is
+        written to mask_name, as mask_dtype, or, if mef is True, as a MASK 
+        extension of the image (see write_image_with_mask). In that case the
+        mask (8 bits) is kept in memory and written by close(), which must be 
+        called (or use a with statement) to finish the files. """
+
+    def __init__(self, filename, shape, dtype, header=None, mask_name=None, 
+                 mask_header=None, mask_dtype=np.int64, mef=False, 
+                 compress=False):
+        self.filename, self.mef, self.compress = filename, mef, compress
+        self.mask_header = mask_header
+        self.image = fits.StreamingHDU(filename, 
+                                       reserve_header_space(
+                                           self._header(shape, dtype, header)))
+        if mef:
+            self.mask = np.zeros(shape, dtype=np.uint8)
+            self.mask_stream = None
+        else:
+            self.mask_stream = fits.StreamingHDU(mask_name, 
+                                   self._header(shape, mask_dtype, mask_header))
+            self.mask_dtype = mask_dtype
+        self.rows = 0
+
+    def _header(self, shape, dtype, header):
+        """ Header of an image of the given shape and type, built from header
+            in the same way astropy does when the whole image is written. """
+        header = fits.PrimaryHDU(np.zeros((1, 1), dtype=dtype), header=header).header
+        header["NAXIS1"], header["NAXIS2"] = shape[1], shape[0]
+        return header
+
+    def write(self, data, mask):
+        """ Write the next block of rows of the image and the mask """
+        self.image.write(np.ascontiguousarray(data))
+        if self.mef:
+            self.mask[self.rows:self.rows + len(data)] = mask
+        else:
+            self.mask_stream.write(np.asarray(mask, dtype=self.mask_dtype))
+        self.rows += len(data)
+
+    def close(self):
+        """ Finish the image and the mask """
+        self.image.close()
+        if self.mef:
+            hdulist = fits.open(self.filename, mode="append")
+            hdulist.append(mask_extension(self.mask, self.mask_header, 
+                                          self.compress))
+            hdulist.close()
+        else:
+            self.mask_stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 def mean_datetime(datetimes):
     """ This function returns the average datetime from a given set of datetime 
@@ -271,52 +420,116 @@ def homogeneous_filter_name(filt):
               " in repipy/utilities.py .  \n \n"
         sys.exit("Exiting program")
 
-def locate_images(directory, pattern):
+class PatternSet(object):
+    """ A dictionary of patterns (key: regular expression), compiled once, to
+        find which of them a name matches. All of them are also compiled in a
+        single alternation, where each pattern is a group named after its 
+        position, so one search discards the names that match none of them
+        (usually most of the files in a directory). The groups of the
+        patterns themselves are only kept in their own compiled version, 
+        since different patterns use the same group names (name, filt...). 
+        If match is True patterns must match at the start of the name (as 
+        re.match), otherwise anywhere (as re.search). """
+
+    def __init__(self, pattern, flags=0, match=False):
+        self.keys = list(pattern.keys())
+        self.compiled = [re.compile(pattern[key], flags) for key in self.keys]
+        self.match = match
+        branches = ["(?P<_%d>%s)" % (ii, re.sub(r"\(\?P<\w+>", "(?:", pattern[key]))
+                    for ii, key in enumerate(self.keys)]
+        try:
+            self.any = re.compile("|".join(branches), flags)
+        except re.error:  # e.g. backreferences to named groups
+            self.any = None
+
+    def matches(self, name):
+        """ List of (key, match) of the patterns that name matches, in the 
+            order of the keys of the dictionary """
+        if self.any is not None:
+            found = self.any.match(name) if self.match else self.any.search(name)
+            if found is None:
+                return []
+            first = int(found.lastgroup[1:]) if self.match else 0
+        else:
+            first = 0
+        result = []
+        for key, compiled in zip(self.keys[first:], self.compiled[first:]):
+            found = compiled.match(name) if self.match else compiled.search(name)
+            if found is not None:
+                result.append((key, found))
+        return result
+
+def find_files(directory, pattern, flags=0, match=False, recursive=True, 
+               jobs=1):
+    """ Files in directory (and its subdirectories, if recursive) whose name
+        matches any of the patterns, a dictionary of regular expressions (see
+        PatternSet). Returns a list of (path, key, match), one per pattern 
+        matched, in the same order os.walk would give them. With jobs > 1 the
+        subdirectories are walked by that many threads. """
+    patterns = PatternSet(pattern, flags, match)
+    def scan(top):
+        """ Files that match in top and, if recursive, its subdirectories """
+        found = []
+        for dd, ss, ff in walk(top):
+            for filename in ff:
+                found.extend((os.path.join(dd, filename), key, match) 
+                             for key, match in patterns.matches(filename))
+            if not recursive:
+                break
+        return found
+    if jobs == 1 or not recursive:
+        return scan(directory)
+    # The files of the top directory, then each subdirectory in a thread
+    dd, ss, ff = next(walk(directory))
+    found = []
+    for filename in ff:
+        found.extend((os.path.join(dd, filename), key, match) 
+                     for key, match in patterns.matches(filename))
+    pool = ThreadPool(jobs)
+    try:
+        for subdir_found in pool.map(scan, [os.path.join(dd, sub) for sub in ss]):
+            found.extend(subdir_found)
+    finally:
+        pool.close()
+    return found
+
+def locate_images(directory, pattern, jobs=1):
     """ Given a directory, save all the files that fit any of the patternsof a 
         dictionary. Save in a dictionary, whose keys are the same as the ones of
         patterns. """
     list_files = collections.defaultdict(list)
-    for dd, ss, ff in os.walk(directory):
-        for filename in ff:
-            for key in pattern.keys():
-                if re.search(pattern[key], filename) != None:
-                    list_files[key].append(os.path.join(dd, filename))
+    for path, key, match in find_files(directory, pattern, jobs=jobs):
+        list_files[key].append(path)
     return list_files
         
-def locate_images2(directory, pattern):
+def locate_images2(directory, pattern, jobs=1):
     """ 
         Given a directory, save all the files that fit any of the patterns of a 
         dictionary. Save in a dictionary, whose keys are 3 numpy arrays that 
         contain the filenames, type (cig, standards, flats) and the object name
         according to the given patterns. 
     """
-    # Empty array of dtype=object is the best way I found to be able to save 
-    # variable length strings in an array. With dtype=string_ it just truncates
-    # the strings if you try to make them longer than the original size.
-    empty_array = np.asarray([], dtype=object)   
-    final_dict = {"filename":empty_array, 
-                  "type":empty_array, 
-                  "objname":empty_array
-                   }
-    for dd, ss, ff in os.walk(directory):
-        for filename in ff:
-            for key in pattern.keys():
-                if re.match(pattern[key], filename) != None:
-                    match = re.search(pattern[key], filename)
-                    match = match.groupdict()
-                    # Find the name of the object 
-                    if key == "cig": 
-                        name = "cig" + str(format(int(match["cig_num"]), "04d"))
-                    elif key == "standards":
-                        name = match["name"]
-                    else:
-                        name = key
-
-                    final_dict["filename"] = np.append(final_dict["filename"],\
-                                                       os.path.join(dd, filename))
-                    final_dict["type"] = np.append(final_dict["type"], key)
-                    final_dict["objname"] = np.append(final_dict["objname"], \
-                                                      name)
+    filenames, types, names = [], [], []
+    for path, key, match in find_files(directory, pattern, match=True, jobs=jobs):
+        match = match.groupdict()
+        # Find the name of the object 
+        if key == "cig": 
+            name = "cig" + str(format(int(match["cig_num"]), "04d"))
+        elif key == "standards":
+            name = match["name"]
+        else:
+            name = key
+        filenames.append(path)
+        types.append(key)
+        names.append(name)
+
+    # Arrays of dtype=object, to be able to save variable length strings. With 
+    # dtype=string_ the strings are truncated if you try to make them longer.
+    final_dict = {}
+    for key, values in [("filename", filenames), ("type", types), 
+                        ("objname", names)]:
+        final_dict[key] = np.empty(len(values), dtype=object)
+        final_dict[key][:] = values
     return final_dict
 
 def create_lists(pattern, directory):
@@ -325,11 +538,10 @@ def create_lists(pattern, directory):
     lista = {}
     for key in pattern.keys():
         lista[key] = []
+    patterns = PatternSet(pattern, re.I)
     for f in os.listdir(directory): 
-        for key in pattern.keys():
-            filename = os.path.join(directory,f)
-            if re.search(pattern[key], filename, re.I) != None:
-                lista[key].append(f)
+        for key, match in patterns.matches(os.path.join(directory,f)):
+            lista[key].append(f)
     return lista
 
 def create_dirs(dirs, directory):
@@ -345,14 +557,13 @@ def name_pattern(pattern, lista):
     a dictionary (e.g: "cig(?P<cig_num>\d{3,4}).fits" would be a valid pattern, 
     "cig(\d{3,4}).fits" would not). lista be a list of names. """
     dictionary = {}
+    patterns = PatternSet(pattern, re.I)
     for filename in lista:
         directory, name = os.path.split(filename)
-        for key in pattern.keys():
-            result = re.search(pattern[key], name, re.I)
-            if result != None:
-                dict_result = result.groupdict()
-                dict_result["key"] = key
-                dictionary[filename] = dict_result
+        for key, result in patterns.matches(name):
+            dict_result = result.groupdict()
+            dict_result["key"] = key
+            dictionary[filename] = dict_result
     return dictionary
 
 def list_dir(directory):
@@ -363,43 +574,98 @@ def list_dir(directory):
         
 def add_history_line(image, text):
     """ Add a history line to the image with the text given """
-    im = fits.open(image, mode="update")
-    hdr = im[0].header
-    hdr.add_history(text)
-    im.flush()
-    im.close()
+    with HeaderTransaction(image) as hdr:
+        hdr.add_history(text)
 
 def header_update_keyword(image, keyword, value, comment=""):
     """ Update a header keyword, or create it if not present """
-    im = fits.open(image, mode="update")
-    hdr = im[0].header
-    hdr.update(keyword, value, comment)
-    im.flush()
-    im.close()
+    with HeaderTransaction(image) as hdr:
+        hdr.update(keyword, value, comment)
+
+# Blank cards reserved at the end of the headers we write or rewrite, so 
+# that the keywords added later fit in the header without moving the data
+header_reserve = 36
+
+def reserve_header_space(header, cards=header_reserve):
+    """ Make sure the header ends with (at least) cards blank cards. New 
+        keywords take the place of the blank cards, so a file can be updated
+        in place instead of rewritten. Returns the header. """
+    free = 0
+    while free < len(header) and header.cards[-free - 1].image.strip() == "":
+        free += 1
+    for ii in range(cards - free):
+        header.append(fits.Card(), useblanks=False, bottom=True)
+    return header
+
+class HeaderTransaction(object):
+    """ Collect edits of the header of an image and apply all of them with a
+        single open and flush of the file, by commit() or at the end of a with
+        statement (unless there was an exception). If the edits do not fit in
+        the blocks of the header the file has to be rewritten, and then some 
+        space is reserved (see reserve_header_space) for the next updates.
+
+        E.g.: with utils.HeaderTransaction(image) as hdr:
+                  hdr.update("FILTER", "R", "Revised filter name")
+                  hdr.add_history(" - Filter name revised") """
+
+    def __init__(self, image):
+        self.image = image
+        self.edits = []
+
+    def update(self, keyword, value, comment=""):
+        """ Update a keyword, or create it if not present """
+        self.edits.append(("update", (keyword, value, comment)))
+
+    def add_history(self, text):
+        """ Add a HISTORY line """
+        self.edits.append(("history", (text,)))
+
+    def add_comment(self, text):
+        """ Add a COMMENT line """
+        self.edits.append(("comment", (text,)))
+
+    def commit(self):
+        """ Apply all the edits collected so far to the file """
+        if not self.edits:
+            return
+        im = fits.open(self.image, mode="update")
+        hdr = im[0].header
+        cards = len(hdr.tostring()) / 80  # whole blocks, END card included
+        for edit, args in self.edits:
+            if edit == "update":
+                keyword, value, comment = args
+                if comment:
+                    hdr[keyword] = (value, comment)
+                else:
+                    hdr[keyword] = value
+            elif edit == "history":
+                hdr.add_history(args[0])
+            elif edit == "comment":
+                hdr.add_comment(args[0])
+        if len(hdr.tostring()) / 80 > cards:  # it is going to be rewritten
+            reserve_header_space(hdr)
+        im.flush()
+        im.close()
+        # The size (and maybe the times) of the file can be the same
+        header_index.forget(self.image)
+        self.edits = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
 
 def read_from_sextractor_catalogue(filename, *keys):
     """ Read from a sextractor catalogue the given keys, for example 
-        keys can be "X_IMAGE", "Y_IMAGE", "MAG_AUTO" """
-    indices = [0] * len(keys)
-    with open(filename, "r") as f:
-        line = f.readline().split()
-        # Read which row the keys have
-        while line[0] == "#": 
-            if line[2] in keys:
-                indices[keys.index(line[2])] = int(line[1]) - 1
-            line = f.readline().split()
-        # If not all keys found
-        if 0 in indices:
-            which_are_zero = [keys[ii] for ii in indices if indices == 0]
-            sys.exit("Impossible to read sextractor catalog, some keys are "+\
-                     "not present: " + ", ".join(which_are_zero))
-                 
-        values = [np.asarray([])] * len(keys) 
-        while line != []:  # until end of file
-            for ii in range(len(keys)):
-                values[ii] = np.append(values[ii], float(line[indices[ii]]))
-            line = f.readline().split()
-        return values
+        keys can be "X_IMAGE", "Y_IMAGE", "MAG_AUTO" (see catalogues)"""
+    catalogue = catalogues.read_sextractor(filename)
+    missing = [key for key in keys if key not in catalogue.dtype.names]
+    if missing:
+        sys.exit("Impossible to read sextractor catalog, some keys are "+\
+                 "not present: " + ", ".join(missing))
+    return [catalogue[key] for key in keys]
          
 def if_exists_remove(*filename):
     """ Check if a file exists. If so, remove it"""
@@ -418,6 +684,18 @@ def if_dir_not_exists_create(folder):
 
 
 
+def memory_size_to_bytes(size):
+    """ Convert a memory size given by the user as a string (e.g. "2GB", 
+        "512MB", "1.5G" or just a number of bytes) into the number of bytes. 
+        Units are powers of 1024. """
+    units = {"":1, "B":1, "K":1024, "KB":1024, "M":1024**2, "MB":1024**2, 
+             "G":1024**3, "GB":1024**3, "T":1024**4, "TB":1024**4}
+    match = re.match(r"^\s*(\d+\.?\d*)\s*([a-zA-Z]*)\s*$", str(size))
+    if match is None or match.group(2).upper() not in units:
+        raise ValueError("Memory size not understood: " + str(size))
+    number, unit = match.groups()
+    return int(float(number) * units[unit.upper()])
+
 def move_list(file_list, target_dir):
     """ Move each of the elements of a list to a given folder """ 
     for item in file_list:             